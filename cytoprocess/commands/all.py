@@ -0,0 +1,66 @@
+import importlib
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import click
+from cytoprocess.utils import setup_logging, needs_rerun, mark_step_done
+
+
+def run(ctx, project, force=False):
+    logger = setup_logging(command="all", project=project, debug=ctx.obj.debug)
+    logger.info("Running all processing steps for project: %s", project)
+
+    # Stages, in order, each with its steps and the arguments of their run() function
+    # NB: the steps of a stage only read the converted .json files and write
+    #     distinct outputs, so they can run concurrently. But parsing .json files
+    #     is CPU bound and extract_meta, extract_cyto and extract_images each use
+    #     a pool of processes as large as the number of CPUs, so they run one
+    #     after the other; summarise_pulses, which runs in a single thread,
+    #     overlaps with the first of them
+    stages = [
+        [("convert", dict(force=force))],
+        [
+            ("extract_meta", dict(list_keys=False)),
+            ("summarise_pulses", dict(force=force)),
+        ],
+        [("extract_cyto", dict(list_keys=False, force=force))],
+        [("extract_images", dict(force=force))],
+        [("compute_features", dict(force=force))],
+        [("prepare", dict(force=force))],
+        [("upload", dict())],
+    ]
+
+    def run_step(step, kwargs):
+        # Skip steps which already ran on the current state of the project
+        params = {k: v for k, v in kwargs.items() if k != "force"}
+        params["sample"] = ctx.obj.sample
+        if not needs_rerun(step, project, params, force=force):
+            logger.info("Skipping %s, project files unchanged since it last ran (use --force to re-run)", step)
+            return
+
+        # Import each step just before running it, so that a failing step
+        # does not pay for the imports of the following ones
+        module = importlib.import_module(f"cytoprocess.commands.{step}")
+        module.run(ctx, project=project, **kwargs)
+
+        mark_step_done(step, project, params)
+
+    for steps in stages:
+        if len(steps) == 1:
+            run_step(*steps[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(steps)) as executor:
+                futures = [executor.submit(run_step, step, kwargs) for step, kwargs in steps]
+            # Re-raise the first error, if any
+            for future in futures:
+                future.result()
+
+    logger.info("All processing steps completed successfully")
+
+
+@click.command(name="all")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--force", is_flag=True, default=False, help="Force processing even if output already exists")
+@click.pass_context
+def command(ctx, project, force):
+    """Run all processing steps in sequence."""
+    run(ctx, project=project, force=force)
@@ -1,50 +1,191 @@
 import logging
-from pathlib import Path
+import os
 import shutil
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+import click
 from cytoprocess.utils import setup_logging, log_command_start, log_command_success, raiseCytoError
 
 
-def _remove_directory(directory: Path, logger: logging.Logger) -> bool:
+def _fast_rmtree(path: Path, logger: logging.Logger) -> int:
+    """Remove a directory tree, walking it iteratively with os.scandir.
+    
+    Files are unlinked as they are listed, relying on the file type reported
+    by the directory entries rather than on a stat of each file; directories
+    are then removed, deepest first.
+    
+    Args:
+        path: Path to the directory to remove
+        logger: Logger instance, to report progress on large trees
+        
+    Returns:
+        int: The number of files removed
+    """
+    n_files = 0
+    stack = [os.fspath(path)]
+    dirs = []
+    while stack:
+        current = stack.pop()
+        dirs.append(current)
+        with os.scandir(current) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                else:
+                    os.unlink(entry.path)
+                    n_files += 1
+                    # Report progress in batches rather than per file
+                    if n_files % 10000 == 0:
+                        logger.info("Removed %d files so far from '%s'", n_files, path)
+    
+    # Directories were listed parents first
+    for d in reversed(dirs):
+        os.rmdir(d)
+    
+    return n_files
+
+
+def _sharded_rmtree(path: Path, logger: logging.Logger, jobs: int) -> int:
+    """Remove a directory tree, removing its subdirectories in parallel.
+    
+    Each top-level subdirectory (e.g. one per sample in `images/`) is a shard
+    removed by its own thread; removal is dominated by filesystem latency
+    rather than CPU so several threads keep the filesystem busy.
+    
+    Args:
+        path: Path to the directory to remove
+        logger: Logger instance, to report progress on large trees
+        jobs: Number of shards removed concurrently
+        
+    Returns:
+        int: The number of files removed
+    """
+    n_files = 0
+    subdirs = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+            else:
+                os.unlink(entry.path)
+                n_files += 1
+    
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        n_files += sum(executor.map(lambda d: _fast_rmtree(d, logger), subdirs))
+    
+    os.rmdir(path)
+    return n_files
+
+
+def _remove_directory(directory: Path, logger: logging.Logger, jobs: int = 1) -> bool:
     """Remove a directory and all its contents.
     
     Args:
         directory: Path to the directory to remove
         logger: Logger instance for logging operations
+        jobs: Number of subdirectories removed concurrently; 1 removes
+            the whole tree in the current thread
         
     Returns:
         bool: True if directory was removed, False if it didn't exist
     """
     
-    logger.debug(f"Checking if '{directory}' exists")
-    if not directory.exists():
-        logger.info(f"Directory does not exist: '{directory}'")
-        return False
-    
+    # Remove everything and let a missing directory surface as FileNotFoundError
+    # (rather than checking its existence first)
+    logger.debug("Removing '%s'", directory)
     try:
-        shutil.rmtree(directory)
-        logger.info(f"Successfully removed '{directory}'")
-        return True
+        if jobs > 1:
+            n_files = _sharded_rmtree(directory, logger, jobs)
+        else:
+            n_files = _fast_rmtree(directory, logger)
+    except FileNotFoundError as e:
+        # Only a missing directory itself means there is nothing to remove;
+        # an entry vanishing during the walk leaves the tree partly removed
+        if e.filename != os.fspath(directory):
+            raiseCytoError(f"Error removing directory: {e}", logger)
+        logger.info("Directory does not exist: '%s'", directory)
+        return False
     except Exception as e:
         raiseCytoError(f"Error removing directory: {e}", logger)
 
+    logger.info("Successfully removed '%s' (%d files)", directory, n_files)
+    return True
 
-def run(ctx, project):
-    logger = setup_logging(command="cleanup", project=project, debug=ctx.obj["debug"])
 
-    log_command_start(logger, "Cleaning up intermediate files", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+def _remove_directories_with_rm(directories: list[Path], rm: str, logger: logging.Logger):
+    """Remove several directories with a single `rm -rf` call.
+    
+    Args:
+        directories: Paths to the directories to remove
+        rm: Path to the `rm` executable
+        logger: Logger instance for logging operations
+    """
+    existing = []
+    for directory in directories:
+        if directory.exists():
+            existing.append(directory)
+        else:
+            logger.info("Directory does not exist: '%s'", directory)
+    if not existing:
+        return
     
-    # Remove directory containing .json files
-    # (they are large and can be reconverted from .cyz files)
-    converted_dir = Path(project) / "converted"
-    _remove_directory(converted_dir, logger)
+    command = [rm, "-rf"] + [str(d) for d in existing]
+    logger.debug("Running command: %s", " ".join(command))
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        raiseCytoError(f"Error removing directories: {result.stderr.strip()}", logger)
+    
+    for directory in existing:
+        logger.info("Successfully removed '%s'", directory)
+
+
+def run(ctx, project, jobs=1):
+    # Directories to remove:
+    # - converted: .json files, which are large and can be reconverted from .cyz files
+    # - work: intermediate storage for metadata
+    # - images: individual images
+    dirs = [project / d for d in ("converted", "work", "images")]
+    dirs = [d for d in dirs if d.exists()]
 
-    # Remove intermediate storage for metadata
-    work_dir = Path(project) / "work"
-    _remove_directory(work_dir, logger)
+    # Exit early, without even setting up logging, when the project is already clean
+    if not dirs:
+        print(f"Nothing to clean up in project '{project}'")
+        return
 
-    # Remove directory with individual images
-    images_dir = Path(project) / "images"
-    _remove_directory(images_dir, logger)
+    logger = setup_logging(command="cleanup", project=project, debug=ctx.obj.debug)
+
+    log_command_start(logger, "Cleaning up intermediate files", project)
+    logger.debug("Context: %s", ctx.obj)
+
+    # images/ can hold millions of files; when several jobs are requested
+    # explicitly, remove it on its own, one sample subdirectory per thread
+    images_dir = project / "images"
+    if jobs > 1 and images_dir in dirs:
+        _remove_directory(images_dir, logger, jobs=jobs)
+        dirs.remove(images_dir)
+    if not dirs:
+        log_command_success(logger, "Cleanup")
+        return
+
+    # On POSIX systems, remove them all in a single pass with `rm -rf`
+    rm = shutil.which("rm") if os.name == "posix" else None
+    if rm:
+        _remove_directories_with_rm(dirs, rm, logger)
+    else:
+        # Otherwise, removal is dominated by filesystem latency and directories
+        # are independent so remove them concurrently
+        with ThreadPoolExecutor(max_workers=len(dirs)) as executor:
+            list(executor.map(lambda d: _remove_directory(d, logger), dirs))
   
     log_command_success(logger, "Cleanup")
+
+
+@click.command(name="cleanup")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--jobs", "-j", type=click.IntRange(min=1), default=1, show_default=True,
+              help="Number of sample directories in images/ removed in parallel; by default, images/ is removed with the other directories")
+@click.pass_context
+def command(ctx, project, jobs):
+    """Remove intermediate files in the project."""
+    run(ctx, project=project, jobs=jobs)
@@ -1,18 +1,21 @@
 import logging
+import os
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import click
 from cytoprocess.utils import get_sample_files, ensure_project_dir, log_command_success, setup_logging, log_command_start, raiseCytoError
 from cytoprocess.commands import install
 
 
-def run(ctx, project, force=False):
-    logger = setup_logging(command="convert", project=project, debug=ctx.obj["debug"])
+def run(ctx, project, force=False, max_parallel=None):
+    logger = setup_logging(command="convert", project=project, debug=ctx.obj.debug)
 
     log_command_start(logger, "Converting .cyz files", project)
     
     if force:
         logger.debug("Force flag enabled: existing .json files will be overwritten")
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     
     # Get .cyz files from raw directory
     cyz_files = get_sample_files(project, logger, kind="cyz", ctx=ctx)
@@ -29,14 +32,13 @@ def run(ctx, project, force=False):
     # Create processed directory if it doesn't exist
     converted_dir = ensure_project_dir(project, "converted")
 
-    # Convert each .cyz file
-    for cyz_file in cyz_files:
+    def convert_file(cyz_file):
         json_file = converted_dir / (cyz_file.stem + ".json")
         
         # Skip if JSON file already exists and force is not enabled
         if json_file.exists() and not force:
             logger.info(f"Skipping '{cyz_file.name}', json file already exists (use --force to overwrite)")
-            continue
+            return
         
         logger.info(f"Converting 'raw/{cyz_file.name}' to 'converted/{json_file.name}'")
         
@@ -59,4 +61,24 @@ def run(ctx, project, force=False):
         except Exception as e:
             raiseCytoError(f"Error converting '{cyz_file.name}': {e}", logger)
 
+    # Convert several .cyz files at once
+    # (threads only wait for the Cyz2Json processes, which run independently)
+    if max_parallel is None:
+        max_parallel = max(1, (os.cpu_count() or 2) // 2)
+    max_parallel = max(1, min(max_parallel, len(cyz_files)))
+    logger.debug(f"Running up to {max_parallel} conversion(s) in parallel")
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        # NB: the first error is re-raised here and cancels the conversions not started yet
+        list(executor.map(convert_file, cyz_files))
+
     log_command_success(logger, "Convert")
+
+
+@click.command(name="convert")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--force", is_flag=True, default=False, help="Force conversion even if .json files already exist")
+@click.option("--max-parallel", type=int, default=None, help="Maximum number of files converted in parallel (default: half the CPU cores)")
+@click.pass_context
+def command(ctx, project, force, max_parallel):
+    """Convert .cyz files to .json format."""
+    run(ctx, project=project, force=force, max_parallel=max_parallel)
@@ -1,34 +1,34 @@
 import shutil
 from pathlib import Path
 
+import click
 from cytoprocess.utils import ensure_project_dir, setup_logging, log_command_start, log_command_success
 
 
 def run(ctx, project):
-    logger = setup_logging(command="create", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="create", project=project, debug=ctx.obj.debug)
 
     log_command_start(logger, "Creating project", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     
-    # Create the main directory if it doesn't exist
-    if (Path(project).exists()):
+    # Report whether the project is new
+    # (the main directory itself is created along with the subdirectories below)
+    if (project.exists()):
         logger.info(f"Project directory '{project}' already exists,\nChecking its contents...")
     else:
         logger.info(f"Creating project directory '{project}'.")
-        ensure_project_dir(project, "")
     
     # List of subdirectories to create
     # NB: others will be created on the fly by the other commands
     subdirectories = ["raw", "meta"]
     
-    # Create each subdirectory
-    for subdir in subdirectories:
-        subdir_path = ensure_project_dir(project, subdir)
-        logger.debug(f"Created/checked subdirectory '{subdir_path}'")
+    # Create each subdirectory, and the main directory with the first one
+    subdir_paths = [ensure_project_dir(project, subdir) for subdir in subdirectories]
+    logger.debug(f"Created/checked subdirectories {', '.join(repr(str(p)) for p in subdir_paths)}")
     
     # Copy metadata configuration template to config directory
     template_file = Path(__file__).parent.parent / "templates" / "config.yaml"
-    dest_file = Path(project) / "config.yaml"
+    dest_file = project / "config.yaml"
     if not dest_file.exists():
         logger.debug(f"Copying configuration template to '{dest_file}'")
         shutil.copy2(template_file, dest_file)
@@ -36,3 +36,11 @@ def run(ctx, project):
         logger.debug(f"Configuration file already exists at '{dest_file}'")
 
     log_command_success(logger, "Create project")
+
+
+@click.command(name="create")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.pass_context
+def command(ctx, project):
+    """Create a new CytoProcess project directory."""
+    run(ctx, project=project)
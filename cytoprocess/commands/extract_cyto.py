@@ -1,10 +1,16 @@
-import yaml
+import os
 import pandas as pd
 from pathlib import Path
-from cytoprocess.utils import get_sample_files, ensure_project_dir, get_json_section, setup_logging, log_command_start, log_command_success, raiseCytoError
+from concurrent.futures import ProcessPoolExecutor
+import click
+from cytoprocess.utils import get_sample_files, ensure_project_dir, get_json_section, JSON_BUF_SIZE, setup_logging, log_command_start, log_command_success, raiseCytoError, load_config, get_worker_context
 import ijson
 import numpy as np
 
+# Stands for a missing parameter dict, so that lookups in it return None
+_EMPTY = {}
+
+
 def _get_parameters_structure(parameters):
     """
     Extract all available paths from a particle's parameters list.
@@ -46,52 +52,156 @@ def _get_parameters_structure(parameters):
     return paths
 
 
-def _get_parameter_value(parameters, path):
+def _extract_sample(json_file, project, mappings, force=False, debug=False):
     """
-    Retrieve a value from a particle's parameters list given a path.
+    Extract the cytometric features of the imaged particles of one sample and save them to Parquet.
     
-    The path format is "description.key" where description identifies the
-    parameter dict and key is the field to retrieve.
+    Runs in a worker process, so it sets up its own logger.
     
     Args:
-        parameters: List of parameter dicts, each with a 'description' key
-        path: Path string (e.g., "FWS.length" or "Sidewards Scatter.total")
-        
-    Returns:
-        The value at the given path, or None if not found.
-        
-    Examples:
-        >>> params = [
-        ...     {'description': 'FWS', 'length': 0.98, 'total': 40621.9},
-        ...     {'description': 'Sidewards Scatter', 'length': 10.77}
-        ... ]
-        >>> _get_parameter_value(params, "FWS.length")
-        0.98
-        >>> _get_parameter_value(params, "Sidewards Scatter.length")
-        10.77
+        json_file: Path to the sample's .json file
+        project: Path to the project directory
+        mappings: Dict of output column name -> (json path, description, key)
+        force: If True, overwrite an existing output file
+        debug: If True, log at DEBUG level
     """
-    # Split path into description and key
-    parts = path.split('.', 1)
-    if len(parts) != 2:
-        return None
-    
-    description, key = parts
+    logger = setup_logging(command="extract_cyto", project=project, debug=debug)
+
+    sample_id = json_file.stem
+    output_file = project / "work" / f"{sample_id}_cytometric_features.parquet"
     
-    # Find the parameter dict with matching description
-    for param_dict in parameters:
-        if not isinstance(param_dict, dict):
-            continue
-        if param_dict.get('description') == description:
-            return param_dict.get(key)
+    # Skip if output file exists and force is not set
+    if output_file.exists() and not force:
+        logger.info(f"Skipping '{json_file.name}', output file already exists (use --force to overwrite)")
+        return
     
-    return None
+    try:
+        logger.info(f"Extracting cytometric features from '{json_file.name}'")
+        
+        # Use the sets definition to compute imaging ratio and imaged/analysed volume
+        # This creates one acquisition per set and we later link each particle to its acquisition
+        sets = get_json_section(json_file, 'set_information', logger)
+        # default acquisition
+        set_stats_df = pd.DataFrame({'name': sample_id,
+                                     'acq_imaging_ratio': 0,
+                                     'acq_imaged_volume_uL': 0,
+                                     'acq_analysed_volume_uL': 0}, index=[0])
+        if sets is None:
+            logger.warning(f"No set information found in '{json_file.name}'; CytoProcess will not be able to compute subsampling factors.")
+        else:
+            # Keep only sets with images and a valid imaged_volume
+            sets_stats = [s for s in sets.get("statistics", []) if
+                          s.get("images", 0) > 0 and
+                          not s.get("imaged_volume") == 'NaN']
+            # Compute relevant quantifies
+            for s in sets_stats:
+                imaging_ratio = np.float32(s['images']) / np.float32(s['count'])
+                analysed_volume = np.float32(s['imaged_volume']) / imaging_ratio
+                sets_stats_df = pd.concat([
+                    set_stats_df,
+                    pd.DataFrame({'name': s['name'],
+                                  'acq_imaging_ratio': imaging_ratio,
+                                  'acq_imaged_volume_uL': np.float32(s['imaged_volume']),
+                                  'acq_analysed_volume_uL': analysed_volume}, index=[0])])
+        # Rename 'name' to its actual meaning
+        sets_stats_df = sets_stats_df.rename(columns={'name': 'acq_id'})
+
+        # Prepare data structure: one list of values per column
+        columns = {'sample_id': [], 'object_id': [], 'acq_id': []}
+        columns.update({full_column_name: [] for full_column_name in mappings})
+        n_particles = 0
+        
+        # log cases with multiple regions, which should not happen but we want to be aware of it if it does
+        multiple_regions = []
+
+        # Stream particles one at a time rather than loading the whole section in memory
+        with open(json_file, 'rb') as f:
+            particles = ijson.items(f, 'particles.item', buf_size=JSON_BUF_SIZE)
+            for particle in particles:
+                n_particles += 1
+
+                # Only process particles with images
+                if not particle.get('hasImage', False):
+                    continue
+
+                particle_idx = particle.get('particleId')
+
+                # Get all its features
+                parameters = particle.get('parameters', [])
+            
+                if not parameters:
+                    logger.debug(f"No parameters for particle {particle_idx} in '{json_file.name}'")
+                    continue
+            
+                # Add a row for this particle
+                columns['sample_id'].append(sample_id)
+                columns['object_id'].append(f"{sample_id}_{particle_idx}")
+
+                # Extract the set the particle is in based on its 'region' property
+                acq_id = 'Other imaged particles'
+                region = particle.get('region', [])
+                if region and len(region) > 0:
+                    # Remove the fact that a given particle is in 'All Imaged Particles' = we don't care
+                    region = [r for r in region if r != 'All Imaged Particles']
+                    if len(region) > 0:
+                        acq_id = region[0]
+                    if len(region) > 1:
+                        multiple_regions.append(tuple(region))
+                    
+                columns['acq_id'].append(acq_id)
+            
+                # Index parameters by description; when several parameters share a description,
+                # the first one wins (hence reversed); ijson yields plain dicts, so test the exact
+                # type, which is cheaper
+                params_by_description = {param_dict.get('description'): param_dict
+                                         for param_dict in reversed(parameters)
+                                         if type(param_dict) is dict}
+                params_by_description.pop(None, None)
+
+                # Extract each mapped value
+                for full_column_name, (json_path, description, key) in mappings.items():
+                    # Get the value from the parameters
+                    value = params_by_description.get(description, _EMPTY).get(key)
+                
+                    if value is None:
+                        logger.debug(f"Path '{json_path}' not found in particle {particle_idx} of '{json_file.name}'")
+                
+                    columns[full_column_name].append(value)
+
+        if n_particles == 0:
+            logger.warning(f"No particles found in '{json_file.name}'")
+            return
+
+        logger.debug(f"Found {n_particles} particles in '{json_file.name}'")
+        
+        if not columns['object_id']:
+            logger.warning(f"No particle data extracted from '{json_file.name}'")
+            return
+
+        # Warn about particles which were in multiple sets
+        if multiple_regions:
+            # Count how many particles were in which combination of sets
+            unique_tuples, counts = np.unique(multiple_regions, axis=0, return_counts=True)
+            multiple_regions_counts = dict(zip(map(lambda x: ', '.join(x), unique_tuples), [int(c) for c in counts]))
+            logger.warning(f"NB: Some particles were in several sets: {multiple_regions_counts}; only the first set has been considered for those particles.")
+
+        # Create DataFrame and save to Parquet
+        df = pd.DataFrame(columns)
+        # add acquisition stats
+        df = df.merge(sets_stats_df, how='left', on='acq_id')
+        df.to_parquet(output_file, index=False)
+        
+        logger.info(f"Saved {df.shape[1]} properties for {df.shape[0]} particles to '{output_file}'")
+        
+    except Exception as e:
+        raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
 
 
 def run(ctx, project, list_keys=False, force=False):
-    logger = setup_logging(command="extract_cyto", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="extract_cyto", project=project, debug=ctx.obj.debug)
 
     log_command_start(logger, "Extracting cytometric features", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     
     # Get JSON files from converted directory
     json_files = get_sample_files(project, logger, kind="json", ctx=ctx)
@@ -110,7 +220,7 @@ def run(ctx, project, list_keys=False, force=False):
             try:
                 with open(json_file, 'rb') as f:
                     # Use ijson to navigate to the particles array and get the first item
-                    parser = ijson.items(f, 'particles.item')
+                    parser = ijson.items(f, 'particles.item', buf_size=JSON_BUF_SIZE)
                     first_particle = next(parser, None)
                     
                 if first_particle is None:
@@ -147,14 +257,13 @@ def run(ctx, project, list_keys=False, force=False):
     else:
         # Normal operation: extract cytometric features based on config.yaml
         
-        config_file = Path(project) / "config.yaml"
+        config_file = project / "config.yaml"
         logger.info(f"Read selected cytometric features list from '{config_file}'")
         
         if not config_file.exists():
             raiseCytoError(f"Configuration file not found: '{config_file}', run 'cytoprocess create {project}' again.", logger)
         
-        with open(config_file, 'r') as f:
-            config = yaml.safe_load(f)
+        config = load_config(config_file)
         
         # Get the 'object' section from config
         object_config = config.get('object')
@@ -162,135 +271,42 @@ def run(ctx, project, list_keys=False, force=False):
             raiseCytoError(f"No 'object' section found in '{config_file}'. Configuration file must contain an 'object' section with cytometric feature mappings.", logger)
         
         logger.debug(f"Found {len(object_config)} mappings in 'object' section")
+
+        # Split each "description.key" path once, rather than for every particle
+        # Prepend 'object_' to column names for EcoTaxa compatibility
+        # (if several paths map to the same column, the last one wins)
+        mappings = {}
+        for json_path, column_name in object_config.items():
+            description, _, key = json_path.partition('.')
+            mappings[f"object_{column_name}"] = (json_path, description if key else None, key)
         
-        # Ensure work directory exists, to store output files
-        work_dir = ensure_project_dir(project, "work")
+        # Ensure work directory exists, to store output files, before the workers start
+        ensure_project_dir(project, "work")
         
         # Process each JSON file and write one Parquet per sample
-        for json_file in json_files:
-            sample_id = json_file.stem
-            output_file = work_dir / f"{sample_id}_cytometric_features.parquet"
-            
-            # Skip if output file exists and force is not set
-            if output_file.exists() and not force:
-                logger.info(f"Skipping '{json_file.name}', output file already exists (use --force to overwrite)")
-                continue
-            
-            try:
-                logger.info(f"Extracting cytometric features from '{json_file.name}'")
-                
-                # Load the particles section of the json file
-                particles_data = get_json_section(json_file, 'particles', logger)
-                
-                if particles_data is None or len(particles_data) == 0:
-                    logger.warning(f"No particles found in '{json_file.name}'")
-                    continue
-                
-                logger.debug(f"Found {len(particles_data)} particles in '{json_file.name}'")
+        # Samples are independent, so process them in parallel, in separate processes
+        # because parsing the .json files is CPU bound
+        n_workers = min(len(json_files), os.cpu_count() or 1)
+        if n_workers == 1:
+            for json_file in json_files:
+                _extract_sample(json_file, project, mappings, force, ctx.obj.debug)
+        else:
+            # Start with the largest files, so that a large file does not run alone at the end
+            json_files = sorted(json_files, key=lambda f: f.stat().st_size, reverse=True)
+            logger.debug(f"Processing samples with {n_workers} worker processes")
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_worker_context()) as executor:
+                futures = [executor.submit(_extract_sample, json_file, project, mappings, force, ctx.obj.debug) for json_file in json_files]
+                for future in futures:
+                    future.result()
 
-                # Use the sets definition to compute imaging ratio and imaged/analysed volume
-                # This creates one acquisition per set and we later link each particle to its acquisition
-                sets = get_json_section(json_file, 'set_information', logger)
-                # default acquisition
-                set_stats_df = pd.DataFrame({'name': sample_id,
-                                             'acq_imaging_ratio': 0,
-                                             'acq_imaged_volume_uL': 0,
-                                             'acq_analysed_volume_uL': 0}, index=[0])
-                if sets is None:
-                    logger.warning(f"No set information found in '{json_file.name}'; CytoProcess will not be able to compute subsampling factors.")
-                else:
-                    # Keep only sets with images and a valid imaged_volume
-                    sets_stats = [s for s in sets.get("statistics", []) if
-                                  s.get("images", 0) > 0 and
-                                  not s.get("imaged_volume") == 'NaN']
-                    # Compute relevant quantifies
-                    for s in sets_stats:
-                        imaging_ratio = np.float32(s['images']) / np.float32(s['count'])
-                        analysed_volume = np.float32(s['imaged_volume']) / imaging_ratio
-                        sets_stats_df = pd.concat([
-                            set_stats_df,
-                            pd.DataFrame({'name': s['name'],
-                                          'acq_imaging_ratio': imaging_ratio,
-                                          'acq_imaged_volume_uL': np.float32(s['imaged_volume']),
-                                          'acq_analysed_volume_uL': analysed_volume}, index=[0])])
-                # Rename 'name' to its actual meaning
-                sets_stats_df = sets_stats_df.rename(columns={'name': 'acq_id'})
-
-                # Prepare data structure: list of dicts, one per particle
-                rows = []
-                
-                # log cases with multiple regions, which should not happen but we want to be aware of it if it does
-                multiple_regions = []
-
-                # Process each particle
-                for particle in particles_data:
-                    # Only process particles with images
-                    if not particle.get('hasImage', False):
-                        continue
-
-                    particle_idx = particle.get('particleId')
-
-                    # Get all its features
-                    parameters = particle.get('parameters', [])
-                    
-                    if not parameters:
-                        logger.debug(f"No parameters for particle {particle_idx} in '{json_file.name}'")
-                        continue
-                    
-                    # Create a row for this particle
-                    row = {
-                        'sample_id': sample_id,
-                        'object_id': f"{sample_id}_{particle_idx}",
-                    }
-
-                    # Extract the set the particle is in based on its 'region' property
-                    acq_id = 'Other imaged particles'
-                    region = particle.get('region', [])
-                    if region and len(region) > 0:
-                        # Remove the fact that a given particle is in 'All Imaged Particles' = we don't care
-                        region = [r for r in region if r != 'All Imaged Particles']
-                        if len(region) > 0:
-                            acq_id = region[0]
-                        if len(region) > 1:
-                            multiple_regions.append(tuple(region))
-                            
-                    row['acq_id'] = acq_id
-                    
-                    # Extract each mapped value
-                    for json_path, column_name in object_config.items():
-                        # Prepend 'object_' to column name for EcoTaxa compatibility
-                        full_column_name = f"object_{column_name}"
-                        
-                        # Get the value from the parameters
-                        value = _get_parameter_value(parameters, json_path)
-                        
-                        if value is None:
-                            logger.debug(f"Path '{json_path}' not found in particle {particle_idx} of '{json_file.name}'")
-                        
-                        row[full_column_name] = value
-                    
-                    rows.append(row)
-                
-                if not rows:
-                    logger.warning(f"No particle data extracted from '{json_file.name}'")
-                    continue
-
-                # Warn about particles which were in multiple sets
-                if multiple_regions:
-                    # Count how many particles were in which combination of sets
-                    unique_tuples, counts = np.unique(multiple_regions, axis=0, return_counts=True)
-                    multiple_regions_counts = dict(zip(map(lambda x: ', '.join(x), unique_tuples), [int(c) for c in counts]))
-                    logger.warning(f"NB: Some particles were in several sets: {multiple_regions_counts}; only the first set has been considered for those particles.")
+    log_command_success(logger, "Extract cytometric features")
 
-                # Create DataFrame and save to Parquet
-                df = pd.DataFrame(rows)
-                # add acquisition stats
-                df = df.merge(sets_stats_df, how='left', on='acq_id')
-                df.to_parquet(output_file, index=False)
-                
-                logger.info(f"Saved {df.shape[1]} properties for {df.shape[0]} particles to '{output_file}'")
-                
-            except Exception as e:
-                raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
 
-    log_command_success(logger, "Extract cytometric features")
+@click.command(name="extract_cyto")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--list", "list_keys", is_flag=True, default=False, help="List all cytometric fields paths found in the .json file(s) instead of extracting some of them")
+@click.option("--force", is_flag=True, default=False, help="Force extraction even if output files already exist")
+@click.pass_context
+def command(ctx, project, list_keys, force):
+    """Extract cytometric features from .json files."""
+    run(ctx, project=project, list_keys=list_keys, force=force)
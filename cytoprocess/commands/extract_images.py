@@ -1,18 +1,133 @@
+import os
 import logging
-import base64
+from binascii import a2b_base64
 import shutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 from pathlib import Path
-from cytoprocess.utils import get_sample_files, ensure_project_dir, get_json_section, setup_logging, log_command_start, log_command_success, raiseCytoError
+import click
+import ijson
+from cytoprocess.utils import get_sample_files, ensure_project_dir, JSON_BUF_SIZE, setup_logging, log_command_start, log_command_success, raiseCytoError, check_project_exists, get_worker_context
+
+# Number of threads writing image files, and maximum number of pending writes
+_WRITE_WORKERS = 8
+_MAX_PENDING_WRITES = 64
+
+# Open images for writing in binary mode, also on Windows
+_WRITE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+
+
+def _write_image(output_file, image_data):
+    """Write raw image bytes to a file, without the overhead of a Python file object."""
+    fd = os.open(output_file, _WRITE_FLAGS, 0o666)
+    try:
+        view = memoryview(image_data)
+        while view:
+            written = os.write(fd, view)
+            view = view[written:]
+    finally:
+        os.close(fd)
+
+
+def _extract_sample_images(json_file, project, force=False, debug=False):
+    """
+    Extract the images of one sample from its .json file into images/<sample>/.
+    
+    Runs in a worker process, so it sets up its own logger.
+    
+    Args:
+        json_file: Path to the sample's .json file
+        project: Path to the project directory
+        force: If True, remove and recreate an existing image directory
+        debug: If True, log at DEBUG level
+        
+    Returns:
+        The number of images extracted.
+    """
+    logger = setup_logging(command="extract_images", project=project, debug=debug)
+
+    try:
+        logger.debug(f"Extracting images from '{json_file.name}'")
+        
+        # Define subdirectory for this sample's images
+        sample_name = json_file.stem
+        sample_images_dir = project / "images" / sample_name
+        
+        # Check if directory already exists
+        if sample_images_dir.exists():
+            if force:
+                logger.info(f"Removing existing directory: '{sample_images_dir}'")
+                shutil.rmtree(sample_images_dir)
+            else:
+                logger.warning(f"Skipping '{json_file.name}', output directory already exists (use --force to overwrite).")
+                return 0
+        
+        # Create the directory
+        sample_images_dir = ensure_project_dir(project, f"images/{sample_name}")
+        
+        image_count = 0
+        n_images = 0
+        # Write files from a pool of threads so that decoding the next image
+        # overlaps with writing the previous ones; limit the number of
+        # pending writes to bound memory use
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=_WRITE_WORKERS) as executor:
+            # Stream images one at a time, to avoid holding all base64 data in memory
+            with open(json_file, 'rb') as f:
+                for image in ijson.items(f, 'images.item', buf_size=JSON_BUF_SIZE):
+                    n_images += 1
+
+                    # Extract particleId and base64 data
+                    particle_id = image.get('particleId')
+                    base64_data = image.get('base64')
+            
+                    if particle_id is None:
+                        logger.warning(f"Image item missing 'particleId' in '{json_file.name}'")
+                        continue
+            
+                    if base64_data is None:
+                        logger.warning(f"Image item {particle_id} missing 'base64' data in '{json_file.name}'")
+                        continue
+            
+                    # Decode base64 data
+                    try:
+                        image_data = a2b_base64(base64_data)
+                    except Exception as e:
+                        logger.error(f"Failed to decode base64 for particle {particle_id} in '{json_file.name}': {e}")
+                        continue
+            
+                    # Write to PNG file
+                    output_file = sample_images_dir / f"{particle_id}.png"
+                    if len(pending) >= _MAX_PENDING_WRITES:
+                        pending.popleft().result()
+                    pending.append(executor.submit(_write_image, output_file, image_data))
+            
+                    image_count += 1
+
+            # Wait for the remaining writes, re-raising any error
+            for future in pending:
+                future.result()
+
+        if n_images == 0:
+            logger.warning(f"No images found in '{json_file.name}'")
+            return 0
+
+        logger.info(f"Extracted {image_count} images from '{json_file.name}' to '{sample_images_dir}'")
+        return image_count
+            
+    except Exception as e:
+        raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
 
 
 def run(ctx, project, force=False):
-    logger = setup_logging(command="extract_images", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="extract_images", project=project, debug=ctx.obj.debug)
+    check_project_exists(project, logger)
 
     log_command_start(logger, "Extracting images", project)
     
     if force:
         logger.debug("Force flag enabled, existing image directories will be removed and recreated")
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     
     # Get JSON files from converted directory
     json_files = get_sample_files(project, logger, kind="json", ctx=ctx)
@@ -22,68 +137,30 @@ def run(ctx, project, force=False):
     logger.info(f"Processing {len(json_files)} .json file(s)")
     
     # Process each JSON file
-    total_images = 0
-    for json_file in json_files:
-        try:
-            logger.debug(f"Extracting images from '{json_file.name}'")
-            
-            # Define subdirectory for this sample's images
-            sample_name = json_file.stem
-            sample_images_dir = Path(project) / "images" / sample_name
-            
-            # Check if directory already exists
-            if sample_images_dir.exists():
-                if force:
-                    logger.info(f"Removing existing directory: '{sample_images_dir}'")
-                    shutil.rmtree(sample_images_dir)
-                else:
-                    logger.warning(f"Skipping '{json_file.name}', output directory already exists (use --force to overwrite).")
-                    continue
-            
-            # Create the directory
-            sample_images_dir = ensure_project_dir(project, f"images/{sample_name}")
-            
-            images = get_json_section(json_file, 'images', logger)
-
-            if images is None:
-                logger.warning(f"No images found in '{json_file.name}'")
-                continue
-            
-            image_count = 0
-            for image in images:
-                # Extract particleId and base64 data
-                particle_id = image.get('particleId')
-                base64_data = image.get('base64')
-                
-                if particle_id is None:
-                    logger.warning(f"Image item missing 'particleId' in '{json_file.name}'")
-                    continue
-                
-                if base64_data is None:
-                    logger.warning(f"Image item {particle_id} missing 'base64' data in '{json_file.name}'")
-                    continue
-                
-                # Decode base64 data
-                try:
-                    image_data = base64.b64decode(base64_data)
-                except Exception as e:
-                    logger.error(f"Failed to decode base64 for particle {particle_id} in '{json_file.name}': {e}")
-                    continue
-                
-                # Write to PNG file
-                output_file = sample_images_dir / f"{particle_id}.png"
-                with open(output_file, 'wb') as img_file:
-                    img_file.write(image_data)
-                
-                image_count += 1
-                    
-            logger.info(f"Extracted {image_count} images from '{json_file.name}' to '{sample_images_dir}'")
-            total_images += image_count
-                
-        except Exception as e:
-            raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
+    # Samples are independent, so process them in parallel, in separate processes
+    # because parsing the .json files and decoding images is CPU bound
+    n_workers = min(len(json_files), os.cpu_count() or 1)
+    if n_workers == 1:
+        image_counts = [_extract_sample_images(json_file, project, force, ctx.obj.debug) for json_file in json_files]
+    else:
+        # Start with the largest files, so that a large file does not run alone at the end
+        json_files = sorted(json_files, key=lambda f: f.stat().st_size, reverse=True)
+        logger.debug(f"Processing samples with {n_workers} worker processes")
+        with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_worker_context()) as executor:
+            futures = [executor.submit(_extract_sample_images, json_file, project, force, ctx.obj.debug) for json_file in json_files]
+            image_counts = [future.result() for future in futures]
+    total_images = sum(image_counts)
     
     logger.info(f"Total images extracted: {total_images}")
     log_command_success(logger, "Extract images")
 
-# TODO add a way to post process the images to remove the background and crop them when they are full frames
\ No newline at end of file
+# TODO add a way to post process the images to remove the background and crop them when they are full frames
+
+
+@click.command(name="extract_images")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--force", is_flag=True, help="Force extraction even if output files already exist")
+@click.pass_context
+def command(ctx, project, force):
+    """Extract images from .json files."""
+    run(ctx, project, force=force)
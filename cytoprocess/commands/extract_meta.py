@@ -1,18 +1,21 @@
+import os
 import logging
 import ijson
-import yaml
 import pandas as pd
 from pathlib import Path
-from cytoprocess.utils import get_sample_files, ensure_project_dir, get_json_section, setup_logging, log_command_start, log_command_success, raiseCytoError
+from itertools import repeat
+from concurrent.futures import ProcessPoolExecutor
+import click
+from cytoprocess.utils import get_sample_files, project_layout, get_json_section, setup_logging, log_command_start, log_command_success, raiseCytoError, load_config, get_worker_context
 
 
 def _get_json_structure(json_data, prefix=""):
     """
-    Recursively extract all keys from a JSON object and return them as full paths.
+    Extract all keys from a JSON object and return them as full paths.
     
     Args:
         json_data: Parsed JSON data (dict, list, or primitive)
-        prefix: The current path prefix (used for recursion)
+        prefix: A prefix prepended to all paths
         
     Returns:
         List of full paths to all keys in the JSON structure.
@@ -31,28 +34,39 @@ def _get_json_structure(json_data, prefix=""):
         ['items[]', 'items[].id', 'items[].name', 'count']
     """
     paths = []
-    
-    if isinstance(json_data, dict):
-        for key, value in json_data.items():
-            # Build the full path
-            current_path = f"{prefix}.{key}" if prefix else key
-            
-            # Recursively get paths from nested structures
-            if isinstance(value, dict):
-                # For dicts, add the key and recurse
-                paths.append(current_path)
-                paths.extend(_get_json_structure(value, current_path))
-            elif isinstance(value, list) and value:
-                # For lists, add the key[] notation
-                list_path = f"{current_path}[]"
-                paths.append(list_path)
-                # If it's a list of dicts, extract structure from first item
-                # (this assummes that all items have the same structure)
-                if isinstance(value[0], dict):
-                    paths.extend(_get_json_structure(value[0], list_path))
-            else:
-                # For non-dict, non-list values, just add the key
-                paths.append(current_path)
+    if not isinstance(json_data, dict):
+        return paths
+
+    # Walk the structure depth-first with an explicit stack of dict iterators,
+    # rather than recursing, so that paths come out in the same order
+    stack = [(iter(json_data.items()), prefix)]
+    while stack:
+        items, current_prefix = stack[-1]
+        item = next(items, None)
+        if item is None:
+            stack.pop()
+            continue
+        key, value = item
+
+        # Build the full path
+        current_path = f"{current_prefix}.{key}" if current_prefix else key
+
+        # Descend into nested structures
+        if isinstance(value, dict):
+            # For dicts, add the key and descend
+            paths.append(current_path)
+            stack.append((iter(value.items()), current_path))
+        elif isinstance(value, list) and value:
+            # For lists, add the key[] notation
+            list_path = f"{current_path}[]"
+            paths.append(list_path)
+            # If it's a list of dicts, extract structure from first item
+            # (this assummes that all items have the same structure)
+            if isinstance(value[0], dict):
+                stack.append((iter(value[0].items()), list_path))
+        else:
+            # For non-dict, non-list values, just add the key
+            paths.append(current_path)
     
     return paths
 
@@ -82,55 +96,141 @@ def _get_json_item(json_data, path):
         >>> _get_json_item(data, "items[].id")
         '1 2 3'
     """
-    path_parts = path.split('.')
+    return _get_compiled_json_item(json_data, _compile_json_path(path))
+
+
+def _compile_json_path(path):
+    """
+    Split a path in dot notation once, so that it can be looked up in many JSON objects.
+    
+    Args:
+        path: Path string (e.g., "user.name" or "items[].id")
+        
+    Returns:
+        Tuple of (key, is_list) pairs, with the [] notation removed from keys.
+        
+    Examples:
+        >>> _compile_json_path("items[].id")
+        (('items', True), ('id', False))
+    """
+    return tuple((part[:-2], True) if part.endswith('[]') else (part, False) for part in path.split('.'))
+
+
+def _get_compiled_json_item(json_data, compiled_path):
+    """
+    Retrieve value(s) from a JSON object given a path compiled by _compile_json_path.
+    
+    See _get_json_item for the lookup rules.
+    """
     current = json_data
-    values = []
     
-    for part in path_parts:
+    for i, (key, is_list) in enumerate(compiled_path):
         if current is None:
             return None
-            
-        # Check if this part refers to a list
-        if part.endswith('[]'):
-            # Remove the [] notation
-            key = part[:-2]
-            
-            # Navigate to the list
-            if isinstance(current, dict) and key in current:
-                list_value = current[key]
-                if isinstance(list_value, list):
-                    # Continue with all list items
-                    remaining_path = '.'.join(path_parts[path_parts.index(part) + 1:])
-                    if remaining_path:
-                        # There are more path components, recurse for each list item
-                        for item in list_value:
-                            result = _get_json_item(item, remaining_path)
-                            if result is not None:
-                                values.append(str(result))
-                    else:
-                        # No more path, just collect the list items
-                        for item in list_value:
-                            values.append(str(item))
-                    # Return concatenated values and stop processing
-                    return ' '.join(values) if values else None
-            else:
-                return None
+        
+        # Navigate to the key, in a dict
+        if not isinstance(current, dict) or key not in current:
+            return None
+        if not is_list:
+            current = current[key]
+            continue
+        
+        # This part refers to a list
+        list_value = current[key]
+        if not isinstance(list_value, list):
+            # Not actually a list: move on to the next part from the same place
+            continue
+        
+        values = []
+        remaining_path = compiled_path[i + 1:]
+        if remaining_path:
+            # There are more path components, look them up in each list item
+            for item in list_value:
+                result = _get_compiled_json_item(item, remaining_path)
+                if result is not None:
+                    values.append(str(result))
         else:
-            # Regular dict key navigation
-            if isinstance(current, dict) and part in current:
-                current = current[part]
-            else:
-                return None
+            # No more path, just collect the list items
+            values = [str(item) for item in list_value]
+        # Return concatenated values and stop processing
+        return ' '.join(values) if values else None
     
     # Return the final value
-    return current if current is not None else None
+    return current
+
+
+# Minimum number of files handled by each worker process
+_FILES_PER_WORKER = 8
+
+# Path to the pixel size (in microns) which is always extracted
+_PIXEL_SIZE_PATH = _compile_json_path('measurementSettings.CytoSettings.CytoSettings.iif.ImageScaleMuPerPixelP')
+
+
+def _extract_sample_metadata(json_file, project, sections, debug=False):
+    """
+    Extract the metadata items defined in the configuration from one .json file.
+    
+    May run in a worker process, so it sets up its own logger.
+    
+    Args:
+        json_file: Path to the sample's .json file
+        project: Path to the project directory
+        sections: List of (section name, items) where items are (json path, column name, compiled path)
+        debug: If True, log at DEBUG level
+        
+    Returns:
+        A dict with one item per column, or None if the file has no instrument section.
+    """
+    logger = setup_logging(command="extract_meta", project=project, debug=debug)
+
+    try:
+        logger.debug(f"Extracting metadata from '{json_file.name}'")
+
+        # Load the instrument section of the json file
+        instrument_data = get_json_section(json_file, 'instrument', logger)
+
+        # If it is found, extract all the metadata keys it contains
+        if instrument_data is None:
+            return None
+
+        # Create a row for this file
+        row = {}
+        
+        # Define the sample_id to join this with the rest of the data
+        row['sample_id'] = json_file.stem
+        # Process each section (sample, acq, process)
+        for section_name, section_items in sections:
+            logger.debug(f"Processing section: {section_name}")
+
+            # Extract each key in this section
+            for json_path, full_column_name, compiled_path in section_items:
+                # Get the value from the JSON
+                value = _get_compiled_json_item(instrument_data, compiled_path)
+                
+                if value is None:
+                    logger.debug(f"Key '{json_path}' not found in {json_file.name}")
+                
+                row[full_column_name] = value
+
+            # Force the inclusion of pixel size because we need it later
+            # (to draw the scale bar on images)
+            row["__pixel_size__"] = _get_compiled_json_item(instrument_data, _PIXEL_SIZE_PATH)
+        
+        logger.info(f"Extracted {len(row)-2} metadata fields from '{json_file.name}'")
+        # NB: -2 to exclude the sample_id and __pixel_size__ fields
+        return row
+        
+    except ijson.JSONError as e:
+        raiseCytoError(f"Failed to parse .json file '{json_file.name}': {e}", logger)
+    except Exception as e:
+        raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
 
 
 def run(ctx, project, list_keys=False):
-    logger = setup_logging(command="extract_meta", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="extract_meta", project=project, debug=ctx.obj.debug)
 
     log_command_start(logger, "Extracting metadata", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
         
     # Get JSON files from converted directory
     json_files = get_sample_files(project, logger, kind="json", ctx=ctx)
@@ -143,107 +243,76 @@ def run(ctx, project, list_keys=False):
         # If the --list argument is provided, extract metadata keys from each JSON file and store them in a text file
         # This will be the basis for the user to create metadata_config.yaml
 
-        keys = []
+        keys = set()
         for json_file in json_files:
             try:
                 # Load the instrument section of the json file
                 instrument_data = get_json_section(json_file, 'instrument', logger)
 
                 # If it is found, extract all the metadata keys it contains
-                if instrument_data is not None:
-                    keys.extend(_get_json_structure(instrument_data))
+                file_keys = _get_json_structure(instrument_data) if instrument_data is not None else []
+                keys.update(file_keys)
                 
             except ijson.JSONError as e:
                 raiseCytoError(f"Failed to parse .json file '{json_file.name}': {e}", logger)
             except Exception as e:
                 raiseCytoError(f"Error reading '{json_file.name}': {e}", logger)
 
-            logger.info(f"Found {len(keys)} metadata items in '{json_file.name}'")
+            logger.info(f"Found {len(file_keys)} metadata items in '{json_file.name}'")
 
-        # If there are multiple json files, deduplicate keys
+        # Keys are deduplicated as they are collected
         if len(json_files) > 1:
-            keys = list(set(keys))
             logger.info(f"Found {len(keys)} unique metadata items across all .json files")
 
         # Make sure config directory exists
-        meta_dir = ensure_project_dir(project, "meta")
+        layout = project_layout(project)
+        layout.ensure("meta")
 
-        # Write keys to file
-        keys_file = meta_dir / "available_metadata_fields.txt"
-        with open(keys_file, 'w') as f:
-            for key_path in sorted(keys):
-                f.write(f"{key_path}\n")
+        # Write keys to file, in one go
+        keys_file = layout.meta / "available_metadata_fields.txt"
+        keys_file.write_text("".join(f"{key_path}\n" for key_path in sorted(keys)))
         
         logger.info(f"Available metadata fields written to {keys_file}. Use them in the sample, acq, and process sections of the config.yaml file to define metadata extraction.")
 
     else:
         # Otherwise, in normal operations, extract specific metadata items based on config.yaml
 
-        config_file = Path(project) / "config.yaml"
+        config_file = project / "config.yaml"
         
         if not config_file.exists():
             raiseCytoError(f"Configuration file not found: '{config_file}', run 'cytoprocess create {project}' again.", logger)
         
         logger.info(f"Read metadata fields list from '{config_file}'")
-        with open(config_file, 'r') as f:
-            config = yaml.safe_load(f)
+        config = load_config(config_file)
+
+        # Parse the paths of the metadata items of each section (sample, acq, process) once
+        # Prepend section name to column names
+        sections = []
+        for section_name in ['sample', 'acq', 'process']:
+            section_keys = config.get(section_name)
+            if not isinstance(section_keys, dict):
+                continue
+            sections.append((section_name, [(json_path, f"{section_name}_{column_name}", _compile_json_path(json_path))
+                                            for json_path, column_name in section_keys.items()]))
         
         # Prepare data structure: list of dicts, one per JSON file
-        metadata_rows = []
-        
-        for json_file in json_files:
-            try:
-                logger.debug(f"Extracting metadata from '{json_file.name}'")
-
-                # Load the instrument section of the json file
-                instrument_data = get_json_section(json_file, 'instrument', logger)
-
-                # If it is found, extract all the metadata keys it contains
-                if instrument_data is None:
-                    continue
-
-                # Create a row for this file
-                row = {}
-                
-                # Define the sample_id to join this with the rest of the data
-                row['sample_id'] = json_file.stem
-                # Process each section (sample, acq, process)
-                for section_name in ['sample', 'acq', 'process']:
-                    section_keys = config.get(section_name)
-                    if not isinstance(section_keys, dict):
-                        continue
-                    
-                    logger.debug(f"Processing section: {section_name}")
-
-                    # Extract each key in this section
-                    for json_path, column_name in section_keys.items():
-                        # Prepend section name to column name
-                        full_column_name = f"{section_name}_{column_name}"
-                        
-                        # Get the value from the JSON
-                        value = _get_json_item(instrument_data, json_path)
-                        
-                        if value is None:
-                            logger.debug(f"Key '{json_path}' not found in {json_file.name}")
-                        
-                        row[full_column_name] = value
-
-                    # Force the inclusion of pixel size because we need it later
-                    # (to draw the scale bar on images)
-                    row["__pixel_size__"] = _get_json_item(instrument_data, 'measurementSettings.CytoSettings.CytoSettings.iif.ImageScaleMuPerPixelP')
-                
-                metadata_rows.append(row)
-                logger.info(f"Extracted {len(row)-2} metadata fields from '{json_file.name}'")
-                # NB: -2 to exclude the sample_id and __pixel_size__ fields
-                
-            except ijson.JSONError as e:
-                raiseCytoError(f"Failed to parse .json file '{json_file.name}': {e}", logger)
-            except Exception as e:
-                raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
+        # Files are independent, so when there are many, parse them in parallel,
+        # in separate processes because parsing is CPU bound; for a few files,
+        # starting the processes costs more than it saves
+        n_workers = min(len(json_files) // _FILES_PER_WORKER, os.cpu_count() or 1)
+        if n_workers < 2:
+            metadata_rows = [_extract_sample_metadata(json_file, project, sections, ctx.obj.debug) for json_file in json_files]
+        else:
+            logger.debug(f"Processing files with {n_workers} worker processes")
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=get_worker_context()) as executor:
+                metadata_rows = list(executor.map(_extract_sample_metadata, json_files, repeat(project), repeat(sections), repeat(ctx.obj.debug),
+                                                  chunksize=_FILES_PER_WORKER))
+        metadata_rows = [row for row in metadata_rows if row is not None]
         
         # Save to paquet in work directory
-        work_dir = ensure_project_dir(project, "work")
-        output_file = work_dir / "sample_metadata_from_instrument.parquet"
+        layout = project_layout(project)
+        layout.ensure("work")
+        output_file = layout.work / "sample_metadata_from_instrument.parquet"
         logger.info(f"Saving metadata to '{output_file}'")
         
         # Create DataFrame from newly extracted metadata
@@ -256,7 +325,8 @@ def run(ctx, project, list_keys=False):
             existing_df = pd.read_parquet(output_file)
             
             # Remove rows from existing_df that have the same sample_id as in new_df
-            existing_df = existing_df[~existing_df['sample_id'].isin(new_df['sample_id'])]
+            new_ids = {row['sample_id'] for row in metadata_rows}
+            existing_df = existing_df[[sample_id not in new_ids for sample_id in existing_df['sample_id'].tolist()]]
 
             logger.debug(f"Updating/appending {len(new_df)} row(s)")
             df = pd.concat([existing_df, new_df], ignore_index=True)
@@ -273,3 +343,11 @@ def run(ctx, project, list_keys=False):
 
     log_command_success(logger, "Extract metadata")
 
+
+@click.command(name="extract_meta")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--list", "list_keys", is_flag=True, default=False, help="List all metadata items found in the .json file(s) instead of extracting some of them")
+@click.pass_context
+def command(ctx, project, list_keys):
+    """Extract sample metadata from .json files."""
+    run(ctx, project=project, list_keys=list_keys)
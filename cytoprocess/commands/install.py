@@ -6,6 +6,7 @@ import json
 import tempfile
 import zipfile
 from pathlib import Path
+import click
 from cytoprocess.utils import log_command_start, log_command_success, setup_logging, raiseCytoError
 
 
@@ -123,22 +124,31 @@ def _download_latest_release(logger) -> str:
     return str(symlink_path)
 
 
+# Path to the cyz2json executable, once found or downloaded in this process
+_CYZ2JSON_PATH = None
+
+
 def _check_or_get_cyz2json(logger) -> str:
     """Get the path to the cyz2json executable, downloading if necessary."""
+    global _CYZ2JSON_PATH
+    if _CYZ2JSON_PATH is not None:
+        return _CYZ2JSON_PATH
+    
     bin_dir = _get_or_create_bin_dir()
     executable_name = _get_executable_name()
     executable_path = bin_dir / executable_name
     
     if not executable_path.exists():
         logger.info(f"Cyz2Json not found at {executable_path}, downloading")
-        return _download_latest_release(logger)
-    
-    logger.debug(f"Using existing cyz2json at {executable_path}")
-    return str(executable_path)
+        _CYZ2JSON_PATH = _download_latest_release(logger)
+    else:
+        logger.debug(f"Using existing cyz2json at {executable_path}")
+        _CYZ2JSON_PATH = str(executable_path)
+    return _CYZ2JSON_PATH
 
 
 def run(ctx):
-    logger = setup_logging(command="install", project=None, debug=ctx.obj["debug"])
+    logger = setup_logging(command="install", project=None, debug=ctx.obj.debug)
     log_command_start(logger, "Installing cyz2json", project=None)
     try:
         path = _check_or_get_cyz2json(logger)
@@ -149,3 +159,10 @@ def run(ctx):
         raise
 
     log_command_success(logger, "Install cyz2json")
+
+
+@click.command(name="install")
+@click.pass_context
+def command(ctx):
+    """Install depency: Cyz2Json converter."""
+    run(ctx)
@@ -1,17 +1,75 @@
+import csv
 import logging
-import pandas as pd
+import os
 from pathlib import Path
-from cytoprocess.utils import ensure_project_dir, get_sample_files, setup_logging, log_command_start, log_command_success
+import click
+from cytoprocess.utils import project_layout, get_sample_files, setup_logging, log_command_start, log_command_success, check_project_exists
 
 
 DEFAULT_EXTRA_FIELDS = "object_lon,object_lat,object_date,object_time,object_depth_min,object_depth_max,object_lon_end,object_lat_end"
 
 
+def _read_samples(meta_file: Path):
+    """
+    Read samples.csv as text, keeping values exactly as they were typed.
+    
+    Args:
+        meta_file: Path to samples.csv
+        
+    Returns:
+        A tuple (fields, rows) with the names of the columns, in order, and
+        the rows as dictionaries.
+    """
+    with open(meta_file, newline='') as f:
+        reader = csv.DictReader(f)
+        rows = list(reader)
+        fields = reader.fieldnames or []
+    return fields, rows
+
+
+def _write_samples(meta_file: Path, fields, rows):
+    """
+    Write samples.csv, leaving empty the fields missing from a row.
+    
+    Args:
+        meta_file: Path to samples.csv
+        fields: Names of the columns, in order
+        rows: Rows of samples.csv, as dictionaries
+    """
+    with open(meta_file, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields, restval='', lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def _append_samples(meta_file: Path, sample_ids, fields):
+    """
+    Append rows for new samples at the end of samples.csv, with only their sample_id filled in.
+    
+    Args:
+        meta_file: Path to samples.csv
+        sample_ids: Identifiers of the new samples
+        fields: Names of the columns of samples.csv, in order
+    """
+    # Make sure new rows start on their own line, even if the file was edited by hand
+    with open(meta_file, 'rb') as f:
+        f.seek(-1, os.SEEK_END)
+        needs_newline = f.read(1) != b'\n'
+    
+    with open(meta_file, 'a', newline='') as f:
+        if needs_newline:
+            f.write('\n')
+        writer = csv.writer(f, lineterminator='\n')
+        for sample_id in sample_ids:
+            writer.writerow([sample_id if field == 'sample_id' else '' for field in fields])
+
+
 def run(ctx, project, extra_fields=DEFAULT_EXTRA_FIELDS):
-    logger = setup_logging(command="list", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="list", project=project, debug=ctx.obj.debug)
+    check_project_exists(project, logger)
 
     log_command_start(logger, "Listing samples", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
 
     # Parse extra fields
     if extra_fields:
@@ -21,61 +79,65 @@ def run(ctx, project, extra_fields=DEFAULT_EXTRA_FIELDS):
     logger.debug(f"Extra fields: {extra_field_list}")
 
     # Create metadata CSV with sample information   
-    meta_dir = ensure_project_dir(project, "meta")
-    meta_file = meta_dir / "samples.csv"
+    layout = project_layout(project)
+    layout.ensure("meta")
+    meta_file = layout.meta / "samples.csv"
     
     # List raw files
     raw_files = get_sample_files(project, logger, kind='cyz', ctx=ctx)
     
-    # Create 'samples' DataFrame
-    samples = pd.DataFrame({
-        'sample_id': [f.stem for f in raw_files]
-    })
-    for field in extra_field_list:
-        samples[field] = None
+    # List sample ids, once each and in order
+    sample_ids = list(dict.fromkeys(f.stem for f in raw_files))
     
     # Print sample IDs to console
-    print(f"{len(samples)} samples found:")
-    for sample_id in samples['sample_id']:
+    print(f"{len(sample_ids)} samples found:")
+    for sample_id in sample_ids:
         print(f"   {sample_id}")
 
     # Read existing metadata if it exists, otherwise create new
-    update_meta_file = True
     if meta_file.exists():
-        existing_samples = pd.read_csv(meta_file)
+        existing_fields, rows = _read_samples(meta_file)
+        existing_ids = {row['sample_id'] for row in rows if 'sample_id' in row}
         
-        # Detect which samples are new
-        new_samples = samples[~samples['sample_id'].isin(existing_samples['sample_id'])]
+        # Detect which samples are new, and which fields are missing
+        new_ids = [sample_id for sample_id in sample_ids if sample_id not in existing_ids]
+        missing_fields = [f for f in extra_field_list if f not in existing_fields]
         
         # If there are no new samples, just ensure extra fields are present
-        if new_samples.empty:
-            missing_fields = [f for f in extra_field_list if f not in existing_samples.columns]
+        if not new_ids:
             if not missing_fields:
-                logger.info(f"No new samples or fields to add to '{meta_file}'")
                 # In that case do not even rewrite the file
-                update_meta_file = False
+                logger.info(f"No new samples or fields to add to '{meta_file}'")
             else:
-                final_df = existing_samples
                 logger.info(f"Adding {len(missing_fields)} new field(s) to '{meta_file}'")
                 for field in missing_fields:
                     logger.debug(f"Adding new column '{field}' to '{meta_file}'")
-                    final_df[field] = None
+                _write_samples(meta_file, existing_fields + missing_fields, rows)
                     
         # If there are new samples, append them
         else:
-            # Detect potentially missing fields in existing samples to inform the user about it
-            missing_fields = [f for f in extra_field_list if f not in existing_samples.columns]
-            logger.info(f"Adding {len(new_samples)} new sample(s)" + (f" and {len(missing_fields)} new field(s)" if missing_fields else "") + f" to '{meta_file}'")
-            logger.debug(f"Missing samples: {new_samples['sample_id'].tolist()}")
+            # Inform the user about potentially missing fields in existing samples
+            logger.info(f"Adding {len(new_ids)} new sample(s)" + (f" and {len(missing_fields)} new field(s)" if missing_fields else "") + f" to '{meta_file}'")
+            logger.debug(f"Missing samples: {new_ids}")
             logger.debug(f"Missing fields: {missing_fields}")
-            final_df = pd.concat([existing_samples, new_samples], ignore_index=True)
+            if not missing_fields:
+                # Append new rows at the end of the file, rather than rewrite it all
+                _append_samples(meta_file, new_ids, existing_fields)
+            else:
+                rows.extend({'sample_id': sample_id} for sample_id in new_ids)
+                _write_samples(meta_file, existing_fields + missing_fields, rows)
    
     else:
-        final_df = samples
-        logger.info(f"Created file '{meta_file}' with {len(samples)} sample(s) and {samples.shape[1]-1} field(s), you can now add custom metadata.")
-    
-    # Still save if we added new columns
-    if update_meta_file:
-        final_df.to_csv(meta_file, index=False)
+        _write_samples(meta_file, ['sample_id'] + extra_field_list, [{'sample_id': sample_id} for sample_id in sample_ids])
+        logger.info(f"Created file '{meta_file}' with {len(sample_ids)} sample(s) and {len(extra_field_list)} field(s), you can now add custom metadata.")
  
     log_command_success(logger, "List samples")
+
+
+@click.command(name="list")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--extra-fields", default=DEFAULT_EXTRA_FIELDS, help="Comma-separated list of extra fields to add as columns in samples.csv")
+@click.pass_context
+def command(ctx, project, extra_fields):
+    """List samples and create/update samples.csv."""
+    run(ctx, project=project, extra_fields=extra_fields)
@@ -1,103 +1,141 @@
+import os
+import functools
 import pandas as pd
 import zipfile
+from itertools import repeat
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.parquet as pq
 from pathlib import Path
 from skimage import io as skio
-from cytoprocess.utils import ensure_project_dir, setup_logging, log_command_start, log_command_success, raiseCytoError
+import imageio.v3 as iio
+import click
+from cytoprocess.utils import ProjectLayout, project_layout, setup_logging, log_command_start, log_command_success, raiseCytoError, check_project_exists, get_worker_context
 
+# Maximum number of samples prepared concurrently
+_MAX_SAMPLE_THREADS = 8
 
-def _infer_ecotaxa_type(series):
+# Number of images sent at once to each worker process adding scale bars
+_IMAGES_PER_TASK = 16
+
+# Maximum number of metadata columns per prefix accepted by EcoTaxa
+_ECOTAXA_MAX_COLUMNS = {'object': 500, 'process': 30, 'acq': 30, 'sample': 60}
+
+
+def _infer_ecotaxa_type(dtype):
     """
-    Infer EcoTaxa column type from pandas Series.
+    Infer EcoTaxa column type from the dtype of a pandas column.
         
     Args:
-        series: pandas Series
+        dtype: dtype of the column
         
     Returns:
         str: '[t]' for text columns and '[f]' for numeric columns.
     """
     # Check if column is numeric
-    if pd.api.types.is_numeric_dtype(series):
+    if pd.api.types.is_numeric_dtype(dtype):
         return '[f]'
     else:
         return '[t]'
 
 
-def _add_scale_bar(input_path: Path, output_path: Path, pixel_size: float):
+# Define a custom minimal 'font' for scale bar text
+_F1 = np.asarray(
+    [[1,1,0,1],
+     [1,0,0,1],
+     [1,1,0,1],
+     [1,1,0,1],
+     [1,1,0,1],
+     [1,1,0,1],
+     [1,1,0,1],
+     [1,1,1,1],
+     [1,1,1,1]])
+_F0 = np.asarray(
+    [[1,1,0,0,1,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,1,0,0,1,1],
+     [1,1,1,1,1,1],
+     [1,1,1,1,1,1]])
+_FU = np.asarray(
+    [[1,1,1,1,1,1],
+     [1,1,1,1,1,1],
+     [1,1,1,1,1,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,0,1,1,0,1],
+     [1,0,0,0,1,1],
+     [1,0,1,1,1,1],
+     [1,0,1,1,1,1]])
+_FM = np.asarray(
+    [[1,1,1,1,1,1],
+     [1,1,1,1,1,1],
+     [1,1,1,1,1,1],
+     [0,0,1,0,1,1],
+     [0,1,0,1,0,1],
+     [0,1,0,1,0,1],
+     [0,1,0,1,0,1],
+     [1,1,1,1,1,1],
+     [1,1,1,1,1,1]])
+
+# Define scale bar sizes and corresponding text, once rather than for each image
+_SCALE_BAR_BREAKS_UM = np.array([1, 10, 100])
+_SCALE_BAR_TEXTS = [np.concatenate((_F1, _FU, _FM), axis=1),
+                    np.concatenate((_F1, _F0, _FU, _FM), axis=1),
+                    np.concatenate((_F1, _F0, _F0, _FU, _FM), axis=1)]
+_SCALE_BAR_INDICES = np.arange(len(_SCALE_BAR_BREAKS_UM))
+
+
+@functools.lru_cache(maxsize=16)
+def _scale_bar_breaks_px(pixel_size: float) -> np.ndarray:
+    """
+    Compute how large the scale bar is, in pixels, for each physical size.
+    
+    The pixel size is the same for all images of a sample, so this is computed
+    once per sample (and per worker process) rather than for each image.
+    
+    Args:
+        pixel_size: Size of one pixel in um
+        
+    Returns:
+        Array of scale bar widths in pixels, one per size in _SCALE_BAR_BREAKS_UM
+    """
+    return np.round(_SCALE_BAR_BREAKS_UM / pixel_size)
+
+
+def _add_scale_bar(input_path: str | Path, pixel_size: float) -> bytes:
     """
     Add a scale bar at the bottom of the image
     
     Args:
         input_path: Path to the source PNG file
-        output_path: Path to write the processed PNG file
         pixel_size: Size of one pixel in um
+        
+    Returns:
+        The processed image, encoded as PNG
     """
 
-    # Define a custom minimal 'font' for scale bar text
-    f1 = np.asarray(
-        [[1,1,0,1],
-         [1,0,0,1],
-         [1,1,0,1],
-         [1,1,0,1],
-         [1,1,0,1],
-         [1,1,0,1],
-         [1,1,0,1],
-         [1,1,1,1],
-         [1,1,1,1]])
-    f0 = np.asarray(
-        [[1,1,0,0,1,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,1,0,0,1,1],
-         [1,1,1,1,1,1],
-         [1,1,1,1,1,1]])
-    fu = np.asarray(
-        [[1,1,1,1,1,1],
-         [1,1,1,1,1,1],
-         [1,1,1,1,1,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,0,1,1,0,1],
-         [1,0,0,0,1,1],
-         [1,0,1,1,1,1],
-         [1,0,1,1,1,1]])
-    fm = np.asarray(
-        [[1,1,1,1,1,1],
-         [1,1,1,1,1,1],
-         [1,1,1,1,1,1],
-         [0,0,1,0,1,1],
-         [0,1,0,1,0,1],
-         [0,1,0,1,0,1],
-         [0,1,0,1,0,1],
-         [1,1,1,1,1,1],
-         [1,1,1,1,1,1]])
-    
-    # Define scale bar sizes and corresponding text
-    breaks_um = np.array([1, 10, 100])
-    t1um  = np.concatenate((f1, fu, fm), axis=1)
-    t10um = np.concatenate((f1, f0, fu, fm), axis=1)
-    t100um = np.concatenate((f1, f0, f0, fu, fm), axis=1)
-    breaks_text = [t1um, t10um, t100um]
-    
     # Read the grayscale image
     img = skio.imread(input_path, as_gray=True)
     img_width_px = img.shape[1]
     
     # Define how large the scale bar is for each physical size
-    breaks_px = np.round(breaks_um / pixel_size)
+    breaks_px = _scale_bar_breaks_px(pixel_size)
 
     # Start the scale bar at these many pixels from the bottom left corner
     pad = 5
 
     # Find the most appropriate scale bar size given the width of the object
-    break_idx = int(np.interp(img_width_px-pad, breaks_px, range(len(breaks_px))))
+    break_idx = int(np.interp(img_width_px-pad, breaks_px, _SCALE_BAR_INDICES))
     
     # Pick the actual size and text we need for this size
     bar_width_px = int(breaks_px[break_idx])
-    bar_text = breaks_text[break_idx]
+    bar_text = _SCALE_BAR_TEXTS[break_idx]
     text_height_px,text_width_px = bar_text.shape
 
     # Define the width and height of the scale bar area
@@ -108,23 +146,24 @@ def _add_scale_bar(input_path: Path, output_path: Path, pixel_size: float):
     # Define the scale bar area background colour as the median of the top row of the image
     backgd_clr = np.median(img[0,:]) 
 
+    # Allocate the output image once, with the scale bar area below the image,
+    # and fill it in place rather than padding and concatenating copies
+    img_height_px = img.shape[0]
+    out = np.empty((img_height_px + h, w), dtype=img.dtype)
+    out[:img_height_px, :img_width_px] = img
     # Pad the input image on the right if it is not wide enough
-    if w > img_width_px:
-        padding_width = w - img_width_px
-        img = np.pad(img, ((0, 0), (0, padding_width)), constant_values=backgd_clr)
+    out[:img_height_px, img_width_px:] = backgd_clr
     
     # Draw a blank scale bar area
-    scale = np.full((h, w), backgd_clr, dtype=img.dtype)
+    scale = out[img_height_px:]
+    scale[:] = backgd_clr
     # Add the scale bar (black)
     scale[h-pad-2:h-pad, pad:(bar_width_px+pad)] = 0
     # Add the text (convert [0,1] to [0,backgd_clr])
     scale[h-pad-4-text_height_px:h-pad-4, pad:(text_width_px+pad)] = (bar_text * backgd_clr).astype(img.dtype)
-    
-    # Combine with the image
-    img = np.concatenate((img, scale), axis=0)
         
-    # Write the processed image
-    skio.imsave(output_path, img)
+    # Encode the processed image in memory, to be written directly in the zip file
+    return iio.imwrite('<bytes>', out, extension='.png')
 
 
 def _list_samples(project: Path, sample_filter: str | None, logger) -> tuple[pd.DataFrame, list[str]]:
@@ -139,7 +178,7 @@ def _list_samples(project: Path, sample_filter: str | None, logger) -> tuple[pd.
     Returns:
         List of sample_ids to process
     """
-    samples_file = project / "meta" / "samples.csv"
+    samples_file = project_layout(project).meta / "samples.csv"
     logger.debug(f"Checking '{samples_file}'")
     if not samples_file.exists():
         raiseCytoError(f"Missing samples metadata file, run `cytoprocess list {project}`.", logger)
@@ -169,7 +208,7 @@ def _detect_extra_samples(project: Path, samples: list[str], logger) -> None:
         samples: List of sample_ids existing in samples.csv
         logger: Logger instance
     """
-    work_dir = project / "work"
+    work_dir = project_layout(project).work
 
     instrument_meta_file = work_dir / "sample_metadata_from_instrument.parquet"
     if instrument_meta_file.exists():
@@ -179,12 +218,15 @@ def _detect_extra_samples(project: Path, samples: list[str], logger) -> None:
     else:
         work_samples = set()
     
-    for pattern, suffix in [("*_cytometric_features.parquet", "_cytometric_features"),
-                            ("*_pulses.parquet", "_pulses"),
-                            ("*_image_features.parquet", "_image_features")]:
-        for file in work_dir.glob(pattern):
-            sample_id = file.stem.replace(suffix, "")
-            work_samples.add(sample_id)
+    # List work/ once and recognise the per-sample files by their suffix
+    suffixes = ("_cytometric_features.parquet", "_pulses.parquet", "_image_features.parquet")
+    with os.scandir(work_dir) as entries:
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            for suffix in suffixes:
+                if entry.name.endswith(suffix):
+                    work_samples.add(entry.name[:-len(suffix)])
     
     extra_samples = work_samples - set(samples)
     if extra_samples:
@@ -205,7 +247,8 @@ def _ensure_sample_data(project: Path, samples: list[str], logger) -> None:
     """
     logger.debug("Verifying required input files for all requested samples")
     
-    work_dir = project / "work"
+    layout = project_layout(project)
+    work_dir = layout.work
     instrument_meta_file = work_dir / "sample_metadata_from_instrument.parquet"
     
     if not instrument_meta_file.exists():
@@ -213,30 +256,36 @@ def _ensure_sample_data(project: Path, samples: list[str], logger) -> None:
 
     logger.debug(f"Reading instrument metadata from '{instrument_meta_file}'")
     instrument_meta_df = pd.read_parquet(instrument_meta_file, columns=['sample_id'])
+    instrument_samples = set(instrument_meta_df['sample_id'].tolist())
+
+    # List the contents of work/ and images/ once, rather than checking each file
+    with os.scandir(work_dir) as entries:
+        work_files = {entry.name for entry in entries}
+    if layout.images.is_dir():
+        with os.scandir(layout.images) as entries:
+            image_dirs = {entry.name for entry in entries if entry.is_dir()}
+    else:
+        image_dirs = set()
     
     at_least_one_missing = False
     for sample_id in samples:
-        if sample_id not in instrument_meta_df['sample_id'].values:
+        if sample_id not in instrument_samples:
             logger.warning(f"Missing metadata from the instrument, run `cytoprocess --sample '{sample_id}' extract_meta {project}`")
             at_least_one_missing = True
 
-        cytometric_file = work_dir / f"{sample_id}_cytometric_features.parquet"
-        if not cytometric_file.exists():
+        if f"{sample_id}_cytometric_features.parquet" not in work_files:
             logger.warning(f"Missing cytometric features, run `cytoprocess --sample '{sample_id}' extract_features {project}`")
             at_least_one_missing = True
 
-        pulses_file = work_dir / f"{sample_id}_pulses.parquet"
-        if not pulses_file.exists():
+        if f"{sample_id}_pulses.parquet" not in work_files:
             logger.warning(f"Missing pulses summary, run `cytoprocess --sample '{sample_id}' summarise_pulses {project}`")
             at_least_one_missing = True
 
-        images_dir = project / "images" / sample_id
-        if not images_dir.exists():
+        if sample_id not in image_dirs:
             logger.warning(f"Images not found, run `cytoprocess --sample '{sample_id}' extract_images {project}`")
             at_least_one_missing = True
         
-        image_features_file = work_dir / f"{sample_id}_image_features.parquet"
-        if not image_features_file.exists():
+        if f"{sample_id}_image_features.parquet" not in work_files:
             logger.warning(f"Missing image features, run `cytoprocess --sample '{sample_id}' compute_features {project}`")
             at_least_one_missing = True
 
@@ -244,6 +293,42 @@ def _ensure_sample_data(project: Path, samples: list[str], logger) -> None:
         raiseCytoError("Missing input for some samples. Please run the required extraction steps before preparing EcoTaxa files.", logger)
     
 
+def _select_object_columns(parquet_files: list[Path], sample_id: str, logger) -> tuple[list[list[str] | None], int]:
+    """
+    Select the columns to read from the object level files of a sample, within EcoTaxa limits.
+    
+    The files are merged in order, and their object columns are truncated to the
+    EcoTaxa limit when writing the TSV (*_id columns first), so the columns beyond
+    the limit do not need to be read at all. Only the file schemas are read here.
+    
+    Args:
+        parquet_files: Paths to the object level files, in the order in which they are merged
+        sample_id: The sample identifier
+        logger: Logger instance
+        
+    Returns:
+        Tuple of (for each file, the list of columns to read or None to read all of them,
+        number of object columns skipped)
+    """
+    names = [pq.read_schema(f).names for f in parquet_files]
+
+    # Columns present in several files (other than the join keys) get renamed
+    # by the merges; do not try to guess the outcome and read everything
+    all_names = [c for file_names in names for c in file_names if c not in ('sample_id', 'object_id')]
+    if len(all_names) != len(set(all_names)):
+        return [None] * len(parquet_files), 0
+
+    object_cols = ['object_id'] + [c for c in all_names if c.startswith('object_')]
+    object_cols = [c for c in object_cols if c.endswith('_id')] + [c for c in object_cols if not c.endswith('_id')]
+    max_cols = _ECOTAXA_MAX_COLUMNS['object'] + 1
+    if len(object_cols) <= max_cols:
+        return [None] * len(parquet_files), 0
+
+    dropped = set(object_cols[max_cols:])
+    logger.debug(f"Skipping {len(dropped)} object columns of sample '{sample_id}' beyond the EcoTaxa limit")
+    return [[c for c in file_names if c not in dropped] for file_names in names], len(dropped)
+
+
 def _merge_sample_data(project: Path, sample_id: str, samples_meta_df: pd.DataFrame, 
                        instrument_meta_df: pd.DataFrame, logger) -> tuple[pd.DataFrame, float]:
     """
@@ -259,35 +344,93 @@ def _merge_sample_data(project: Path, sample_id: str, samples_meta_df: pd.DataFr
     Returns:
         Tuple of (merged DataFrame, pixel_size in mm)
     """
-    work_dir = project / "work"
+    work_dir = project_layout(project).work
     
     # Get sample-level metadata for this sample
     sample_meta = samples_meta_df[samples_meta_df['sample_id'] == sample_id]
     instrument_meta = instrument_meta_df[instrument_meta_df['sample_id'] == sample_id]
     
     # Read object metadata files for this sample
-    cytometric_df = pd.read_parquet(work_dir / f"{sample_id}_cytometric_features.parquet")
-    image_features_df = pd.read_parquet(work_dir / f"{sample_id}_image_features.parquet")
-    pulses_df = pd.read_parquet(work_dir / f"{sample_id}_pulses.parquet")
+    # skipping the object columns that would be truncated anyway
+    object_files = [work_dir / f"{sample_id}_cytometric_features.parquet",
+                    work_dir / f"{sample_id}_image_features.parquet",
+                    work_dir / f"{sample_id}_pulses.parquet"]
+    columns, n_skipped = _select_object_columns(object_files, sample_id, logger)
+    cytometric_df, image_features_df, pulses_df = [pd.read_parquet(f, columns=c) for f, c in zip(object_files, columns)]
 
     # Extract pixel size from our custom column and remove it
     pixel_size = np.float32(instrument_meta.iloc[0]['__pixel_size__'])
     instrument_meta = instrument_meta.drop(columns=['__pixel_size__'])
 
-    # Merge all data
-    df = cytometric_df.merge(image_features_df, on=['sample_id', 'object_id'], how='left')
-    df = df.merge(pulses_df, on=['sample_id', 'object_id'], how='left')
-    df = df.merge(sample_meta, on=['sample_id'], how='left')
-    df = df.merge(instrument_meta, on=['sample_id'], how='left')
+    # Merge all object level data
+    keys = ['sample_id', 'object_id']
+    indexed_dfs = [d.set_index(keys) for d in (cytometric_df, image_features_df, pulses_df)]
+    other_cols = [c for d in indexed_dfs[1:] for c in d.columns]
+    if all(d.index.is_unique for d in indexed_dfs) and \
+       len(set(other_cols)) == len(other_cols) and not set(other_cols) & set(indexed_dfs[0].columns):
+        # Objects are unique and column names do not clash: align the other files
+        # on the cytometric features (as a left join would) and bind all columns at once
+        index = indexed_dfs[0].index
+        df = pd.concat([indexed_dfs[0]] + [d.reindex(index) for d in indexed_dfs[1:]], axis=1).reset_index()
+    else:
+        df = cytometric_df.merge(image_features_df, on=keys, how='left')
+        df = df.merge(pulses_df, on=keys, how='left')
+
+    # Add sample level data (one row) to all objects
+    sample_level = sample_meta.merge(instrument_meta, on=['sample_id'], how='outer')
+    sample_cols = sample_level.columns.drop('sample_id')
+    if len(sample_level) == 1 and not sample_cols.isin(df.columns).any():
+        # Repeat the single row for every object, rather than joining on sample_id;
+        # taking rows keeps the dtype of each column, as the merge would
+        broadcast = sample_level[sample_cols].take(np.zeros(len(df), dtype=np.intp)).set_axis(df.index)
+        df = pd.concat([df, broadcast], axis=1)
+    else:
+        df = df.merge(sample_level, on=['sample_id'], how='left')
 
     # Define process_id as acq_id
     df['process_id'] = df['acq_id']
 
+    # Keep track of the skipped columns, to report them when truncating
+    df.attrs['skipped_columns'] = {'object': n_skipped}
+
     logger.debug(f"Found {len(df)} objects for sample '{sample_id}'")
     
     return df, pixel_size
 
 
+def _write_tsv_rows(df: pd.DataFrame, f) -> None:
+    """
+    Write the rows of a DataFrame as tab-separated values, without header.
+    
+    Rows are encoded by Arrow's C++ CSV writer, which is much faster than pandas'.
+    Numbers are written in their shortest form (e.g. 2 rather than 2.0). Values
+    are never quoted; if some text contains tabs, quotes, or newlines, fall back
+    on pandas, which quotes them.
+    
+    Args:
+        df: DataFrame to write
+        f: File object open in binary mode
+    """
+    # Format generic Python objects (e.g. decimals or lists read from the .json
+    # files) and booleans with str(), as pandas does, and missing values as ''
+    columns = {}
+    for col in df.columns:
+        values = df[col]
+        if values.dtype == object or pd.api.types.is_bool_dtype(values):
+            values = values.astype(str).where(values.notna(), '')
+        columns[col] = values
+    table = pa.Table.from_pandas(pd.DataFrame(columns), preserve_index=False)
+
+    # Encode into memory first, so that nothing is written to the file if we need to fall back
+    sink = pa.BufferOutputStream()
+    try:
+        pacsv.write_csv(table, sink, write_options=pacsv.WriteOptions(include_header=False, delimiter='\t', quoting_style='none'))
+    except pa.ArrowInvalid:
+        f.write(df.to_csv(sep='\t', index=False, header=False).encode())
+    else:
+        f.write(sink.getvalue())
+
+
 def _prepare_ecotaxa_tsv(df: pd.DataFrame, tsv_file: Path, logger) -> pd.DataFrame:
     """
     Prepare and write EcoTaxa TSV file with column type inference.
@@ -304,77 +447,76 @@ def _prepare_ecotaxa_tsv(df: pd.DataFrame, tsv_file: Path, logger) -> pd.DataFra
     """
     # Get the sample_id value from the assembled data (same for all rows)
     sample_id = df["sample_id"].iloc[0]
+    # Get the number of columns per prefix not read because they were beyond EcoTaxa limits
+    skipped_columns = df.attrs.get('skipped_columns', {})
     
     # Add image filename based on object_id
-    df['img_file_name'] = df['object_id'].str.replace(f"{sample_id}_", "", n=1) + ".png"
+    # (object_id is "{sample_id}_{particle_id}", so just remove the known-length prefix)
+    df['img_file_name'] = df['object_id'].str.slice(len(sample_id) + 1) + ".png"
     
     # Add img_rank (0-based index for multiple images per object)
     df['img_rank'] = 0
 
     # Reorder columns to put all *_id columns first, for cleanness
+    # (only the names: the columns are selected once, in their final order, below)
     id_cols = [c for c in df.columns if c.endswith('_id')]
     other_cols = [c for c in df.columns if not c.endswith('_id')]
-    df = df[id_cols + other_cols]
-
-    # Count columns per prefix and enforce EcoTaxa limits
-    cols = df.columns.tolist()
-    img_cols = [c for c in cols if c.startswith('img_')]
-    object_cols = [c for c in cols if c.startswith('object_')]
-    process_cols = [c for c in cols if c.startswith('process_')]
-    acq_cols = [c for c in cols if c.startswith('acq_')]
-    sample_cols = [c for c in cols if c.startswith('sample_')]
-
-    # Limit object metadata columns to 500
-    # NB: since object_id does not count as metadata, this means a maximum of 501 columns
+
+    # Sort columns by prefix, in a single pass
+    buckets = {'img': [], 'object': [], 'process': [], 'acq': [], 'sample': []}
+    for col in id_cols + other_cols:
+        prefix, sep, _ = col.partition('_')
+        bucket = buckets.get(prefix) if sep else None
+        if bucket is not None:
+            bucket.append(col)
+
+    # Enforce EcoTaxa limits on the number of metadata columns
+    # NB: the *_id column does not count as metadata, hence the +1
     # TODO actually object_lon, lat etc. do not count either so we could add more columns
-    if len(object_cols) > 501:
-        logger.warning(f"Sample '{sample_id}' has {len(object_cols)-1} object metadata columns, truncating to 500 (EcoTaxa limit)")
-        object_cols = object_cols[:501]
-    # Limit sample, process, and acq columns
-    if len(process_cols) > 31:
-        logger.warning(f"Sample '{sample_id}' has {len(process_cols)-1} process metadata columns, truncating to 30 (EcoTaxa limit)")
-        process_cols = process_cols[:31]
-    if len(acq_cols) > 31:
-        logger.warning(f"Sample '{sample_id}' has {len(acq_cols)-1} acq metadata columns, truncating to 30 (EcoTaxa limit)")
-        acq_cols = acq_cols[:31]
-    if len(sample_cols) > 61:
-        logger.warning(f"Sample '{sample_id}' has {len(sample_cols)-1} sample metadata columns, truncating to 60 (EcoTaxa limit)")
-        sample_cols = sample_cols[:61]
+    for prefix, max_cols in _ECOTAXA_MAX_COLUMNS.items():
+        n_cols = len(buckets[prefix]) - 1 + skipped_columns.get(prefix, 0)
+        if n_cols > max_cols:
+            logger.warning(f"Sample '{sample_id}' has {n_cols} {prefix} metadata columns, truncating to {max_cols} (EcoTaxa limit)")
+            buckets[prefix] = buckets[prefix][:max_cols + 1]
 
     # Order columns for cleanness
-    ordered_cols = img_cols + object_cols + process_cols + acq_cols + sample_cols
+    ordered_cols = buckets['img'] + buckets['object'] + buckets['process'] + buckets['acq'] + buckets['sample']
     sorted_df = df[ordered_cols]
     
-    # Create type indicators row
-    type_row = {col: _infer_ecotaxa_type(sorted_df[col]) for col in sorted_df.columns}
+    # Create type indicators row, from the dtypes only, without accessing each column
+    type_row = [_infer_ecotaxa_type(dtype) for dtype in sorted_df.dtypes]
     
     # Create the EcoTaxa .tsv file
-    with open(tsv_file, 'w') as f:
-        f.write('\t'.join(sorted_df.columns) + '\n')
-        f.write('\t'.join([type_row[col] for col in sorted_df.columns]) + '\n')
-        sorted_df.to_csv(f, sep='\t', index=False, header=False)
+    with open(tsv_file, 'wb') as f:
+        f.write(('\t'.join(sorted_df.columns) + '\n').encode())
+        f.write(('\t'.join(type_row) + '\n').encode())
+        _write_tsv_rows(sorted_df, f)
     
     logger.debug(f"Saved {sorted_df.shape[1]} fields for {sorted_df.shape[0]} objects to '{tsv_file}'")
     return sorted_df
 
 
 def _create_ecotaxa_zip(tsv_file: Path, zip_file: Path, images_dir: Path, 
-                        ecotaxa_dir: Path, pixel_size: float, logger) -> None:
+                        pixel_size: float, logger, executor=None) -> None:
     """
     Create EcoTaxa ZIP file containing TSV and processed images with scale bars.
     
-    Cleans up temporary files (TSV and processed images) after creating the ZIP.
+    Processed images are written directly into the ZIP. Cleans up the TSV file after creating the ZIP.
     
     Args:
         tsv_file: Path to the TSV file to include
         zip_file: Path to output ZIP file
         images_dir: Directory containing source PNG images
-        ecotaxa_dir: Directory for temporary processed images
         pixel_size: Pixel size in mm (for scale bar)
         logger: Logger instance
+        executor: Optional pool of processes in which to add the scale bars
     """
-    image_files = list(images_dir.glob("*.png"))
-    processed_images = []
+    # List the images with their names, without creating Path objects or calling stat
+    # (skip hidden files, as a "*.png" glob would)
+    with os.scandir(images_dir) as entries:
+        image_files = [(entry.path, entry.name) for entry in entries
+                       if entry.name.endswith('.png') and not entry.name.startswith('.')]
+    image_paths = [path for path, _ in image_files]
     
     with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_DEFLATED) as zf:
         # Add the TSV file
@@ -383,39 +525,84 @@ def _create_ecotaxa_zip(tsv_file: Path, zip_file: Path, images_dir: Path,
         # Process and add all images from the sample's images directory
         logger.debug(f"Processing and adding {len(image_files)} images to zip file")
         
-        for image_file in image_files:
-            # Process image: add scale bar at bottom
-            processed_path = ecotaxa_dir / image_file.name
-            _add_scale_bar(image_file, processed_path, pixel_size)
-            processed_images.append(processed_path)
-            
-            # Add to zip
-            zf.write(processed_path, processed_path.name)
+        # Process images: add scale bar at bottom
+        # Decoding and encoding PNGs is CPU bound, so do it in other processes when possible;
+        # results come back in order and are added to the zip from here
+        if executor is None:
+            results = map(_add_scale_bar, image_paths, repeat(pixel_size))
+        else:
+            results = executor.map(_add_scale_bar, image_paths, repeat(pixel_size),
+                                   chunksize=_IMAGES_PER_TASK)
+        for (_, image_name), png_data in zip(image_files, results):
+            # Add to zip, without compression: PNG data is already compressed
+            zf.writestr(image_name, png_data, compress_type=zipfile.ZIP_STORED)
     
     logger.debug(f"Created zip file '{zip_file}' with {len(image_files)} images")
 
     # Remove the TSV file after adding it to the zip
     logger.debug(f"Removing temporary TSV file '{tsv_file}'")
     tsv_file.unlink()
+
+
+def _prepare_sample(sample_id: str, layout: ProjectLayout, samples_meta_df: pd.DataFrame,
+                    instrument_meta_df: pd.DataFrame, force: bool, only_tsv: bool, logger,
+                    image_executor=None) -> None:
+    """
+    Prepare the EcoTaxa TSV file, and ZIP file unless only_tsv is set, of one sample.
+    
+    May run in a thread, concurrently with other samples.
+    
+    Args:
+        sample_id: The sample identifier
+        layout: ProjectLayout of the project
+        samples_meta_df: DataFrame with custom sample-level metadata
+        instrument_meta_df: DataFrame with sample-level metadata from the instrument
+        force: If True, overwrite existing output files
+        only_tsv: If True, only create the TSV file
+        logger: Logger instance
+        image_executor: Optional pool of processes in which to add scale bars to images
+    """
+    tsv_file = layout.ecotaxa / f"ecotaxa_{sample_id}.tsv"
+    zip_file = layout.ecotaxa / f"ecotaxa_{sample_id}.zip"
+
+    # Skip if output file exists and force is not set
+    if (tsv_file.exists() and only_tsv and not force) or \
+       (zip_file.exists() and not only_tsv and not force):
+        logger.info(f"Skipping '{sample_id}', ecotaxa_*." + ("tsv" if only_tsv else "zip") + " file already exists (use --force to overwrite)")
+        return
     
-    # Remove processed images after adding them to the zip
-    logger.debug(f"Removing {len(processed_images)} temporary processed images")
-    for processed_path in processed_images:
-        processed_path.unlink()
+    logger.info(f"Collating '{tsv_file}'")
+
+    # Merge all data for this sample
+    df, pixel_size = _merge_sample_data(layout.root, sample_id, samples_meta_df, instrument_meta_df, logger)
+
+    # Prepare TSV file
+    _prepare_ecotaxa_tsv(df, tsv_file, logger)
+    
+    if only_tsv:
+        logger.debug("Skipping zip creation, only TSV file requested (--only-tsv)")
+        return
+
+    # Create zip file
+    logger.info(f"Assembling '{zip_file}'")
+    images_dir = layout.images / sample_id
+    _create_ecotaxa_zip(tsv_file, zip_file, images_dir, pixel_size, logger, image_executor)
+    # TODO move image processing in extract_images
 
 
 def run(ctx, project, force=False, only_tsv=False):
     """Prepare EcoTaxa TSV/ZIP files for samples."""
-    logger = setup_logging(command="prepare", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="prepare", project=project, debug=ctx.obj.debug)
+    check_project_exists(project, logger)
     
     log_command_start(logger, "Preparing EcoTaxa files", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     if only_tsv:
         logger.debug("Only creating TSV files (--only-tsv flag enabled)")
 
-    project = Path(project)
-    work_dir = project / "work"
-    sample_filter = getattr(ctx, "obj", {}).get("sample")
+    layout = project_layout(project)
+    work_dir = layout.work
+    sample_filter = ctx.obj.sample
 
     # List samples to process from meta/samples.csv
     samples = _list_samples(project, sample_filter, logger)        
@@ -429,39 +616,49 @@ def run(ctx, project, force=False, only_tsv=False):
     _ensure_sample_data(project, samples, logger)
 
     # Prepare storage
-    ecotaxa_dir = ensure_project_dir(project, "ecotaxa")
+    layout.ensure("ecotaxa")
 
     # Read sample-level metadata and instrument metadata
     # We do not need checks here these the existence of these files is already verified 
-    samples_meta_df = pd.read_csv(project / "meta" / "samples.csv")
-    instrument_meta_df = pd.read_parquet(work_dir / "sample_metadata_from_instrument.parquet")
-
-    for sample_id in samples:
-        tsv_file = ecotaxa_dir / f"ecotaxa_{sample_id}.tsv"
-        zip_file = ecotaxa_dir / f"ecotaxa_{sample_id}.zip"
-
-        # Skip if output file exists and force is not set
-        if (tsv_file.exists() and only_tsv and not force) or \
-           (zip_file.exists() and not only_tsv and not force):
-            logger.info(f"Skipping '{sample_id}', ecotaxa_*." + ("tsv" if only_tsv else "zip") + " file already exists (use --force to overwrite)")
-            continue
-        
-        logger.info(f"Collating '{tsv_file}'")
+    samples_meta_df = pd.read_csv(layout.meta / "samples.csv")
+    # (only the rows of the samples to process, filtered while reading the file)
+    instrument_meta_df = pd.read_parquet(work_dir / "sample_metadata_from_instrument.parquet",
+                                         filters=[('sample_id', 'in', [str(s) for s in samples])])
+
+    # Samples are independent, so process them concurrently; threads are enough
+    # because most of the work (reading parquet files, writing the TSV, encoding
+    # images) happens in native code which releases the GIL, and they share the
+    # metadata tables rather than copying them to other processes
+    # Images are processed in a pool of processes shared by all samples
+    n_image_workers = 1 if only_tsv else (os.cpu_count() or 1)
+    image_executor = None
+    if n_image_workers > 1:
+        logger.debug(f"Processing images with {n_image_workers} worker processes")
+        image_executor = ProcessPoolExecutor(max_workers=n_image_workers, mp_context=get_worker_context())
+    try:
+        n_workers = min(len(samples), _MAX_SAMPLE_THREADS)
+        if n_workers <= 1:
+            for sample_id in samples:
+                _prepare_sample(sample_id, layout, samples_meta_df, instrument_meta_df, force, only_tsv, logger, image_executor)
+        else:
+            logger.debug(f"Processing samples with {n_workers} threads")
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                futures = [executor.submit(_prepare_sample, sample_id, layout, samples_meta_df, instrument_meta_df, force, only_tsv, logger, image_executor)
+                           for sample_id in samples]
+                for future in futures:
+                    future.result()
+    finally:
+        if image_executor is not None:
+            image_executor.shutdown()
 
-        # Merge all data for this sample
-        df, pixel_size = _merge_sample_data(project, sample_id, samples_meta_df, instrument_meta_df,   logger)
-
-        # Prepare TSV file
-        _prepare_ecotaxa_tsv(df, tsv_file, logger)
-        
-        if only_tsv:
-            logger.debug("Skipping zip creation, only TSV file requested (--only-tsv)")
-            continue
+    log_command_success(logger, "Prepare EcoTaxa files")
 
-        # Create zip file
-        logger.info(f"Assembling '{zip_file}'")
-        images_dir = project / "images" / sample_id
-        _create_ecotaxa_zip(tsv_file, zip_file, images_dir, ecotaxa_dir, pixel_size, logger)
-        # TODO move image processing in extract_images
 
-    log_command_success(logger, "Prepare EcoTaxa files")
+@click.command(name="prepare")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--force", is_flag=True, help="Force preparation even if output files already exist")
+@click.option("--only-tsv", is_flag=True, help="Only create TSV files, skip zip file creation (useful to update metadata only)")
+@click.pass_context
+def command(ctx, project, force, only_tsv):
+    """Prepare .tsv and images for EcoTaxa."""
+    run(ctx, project, force=force, only_tsv=only_tsv)
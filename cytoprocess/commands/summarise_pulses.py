@@ -1,7 +1,9 @@
 import logging
 import numpy as np
 import pandas as pd
+from pathlib import Path
 from numpy.polynomial.polynomial import Polynomial
+import click
 from cytoprocess.utils import get_sample_files, ensure_project_dir, get_json_section, setup_logging, log_command_start, log_command_success, raiseCytoError
 
 
@@ -42,10 +44,10 @@ def _fit_polynomial(pulse, n_poly):
 
 
 def run(ctx, project, n_poly=10, force=False):
-    logger = setup_logging(command="summarise_pulses", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="summarise_pulses", project=project, debug=ctx.obj.debug)
 
     log_command_start(logger, "Summarising pulse shapes", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     logger.debug(f"Using {n_poly} polynomial coefficients")
     
     # Get JSON files from converted directory
@@ -141,3 +143,13 @@ def run(ctx, project, n_poly=10, force=False):
             raiseCytoError(f"Error processing '{json_file.name}': {e}", logger)
 
     log_command_success(logger, "Summarise pulses")
+
+
+@click.command(name="summarise_pulses")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--n-poly", default=10, help="Number of polynomial coefficients")
+@click.option("--force", is_flag=True, default=False, help="Force processing even if output files already exist")
+@click.pass_context
+def command(ctx, project, n_poly, force):
+    """Summarise pulse shapes."""
+    run(ctx, project=project, n_poly=n_poly, force=force)
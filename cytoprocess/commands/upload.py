@@ -2,10 +2,10 @@ import logging
 import getpass
 from pathlib import Path
 import time
-import yaml
 import keyring
 import requests
-from cytoprocess.utils import setup_logging, log_command_start, log_command_success, raiseCytoError
+import click
+from cytoprocess.utils import setup_logging, log_command_start, log_command_success, raiseCytoError, check_project_exists, load_config
 
 # EcoTaxa API base URL
 ECOTAXA_API_URL = "https://ecotaxa.obs-vlfr.fr/api"
@@ -359,12 +359,12 @@ def monitor_job(token: str, job_id: int, poll_interval: float = 2.0) -> bool:
 
 
 def run(ctx, project, username: str | None = None, password: str | None = None):
-    logger = setup_logging(command="upload", project=project, debug=ctx.obj["debug"])
+    logger = setup_logging(command="upload", project=project, debug=ctx.obj.debug)
+    check_project_exists(project, logger)
 
     log_command_start(logger, "Uploading samples to EcoTaxa", project)
-    logger.debug("Context: %s", getattr(ctx, "obj", {}))
+    logger.debug("Context: %s", ctx.obj)
     
-    project = Path(project)
     # TODO abstract cheching the existence of the prpoject and of some files in it in a function; have it raise a FileNotFound error and handle it with try:except in cli.py
 
     # Load config from project
@@ -372,8 +372,7 @@ def run(ctx, project, username: str | None = None, password: str | None = None):
     if not config_path.exists():
         raiseCytoError(f"Config file not found: '{config_path}', run 'cytoprocess create {project}' again.", logger)
 
-    with open(config_path, 'r') as f:
-        config = yaml.safe_load(f) or {}
+    config = load_config(config_path) or {}
     
     # Get project_id from config
     ecotaxa_config = config.get("ecotaxa", {}) or {}
@@ -465,3 +464,13 @@ def run(ctx, project, username: str | None = None, password: str | None = None):
             logger.warning(f"  ✗ Import failed or requires manual intervention")
 
     log_command_success(logger, "Upload")
+
+
+@click.command(name="upload")
+@click.argument("project", type=click.Path(path_type=Path))
+@click.option("--username", "-u", help="EcoTaxa email address")
+@click.option("--password", "-p", help="EcoTaxa password")
+@click.pass_context
+def command(ctx, project, username, password):
+    """Upload files to EcoTaxa. """
+    run(ctx, project, username=username, password=password)
@@ -1,18 +1,102 @@
 """Utility functions for cytoprocess."""
 
 import logging
+import logging.config
+import multiprocessing
+import os
 import click
 import ijson
+import yaml
 from pathlib import Path
 from datetime import datetime
 import copy
+import functools
+import hashlib
+import json
 import re
+import threading
+from dataclasses import dataclass
+
+
+# Global options of the command line interface, stored in click's ctx.obj
+@dataclass(frozen=True, slots=True)
+class CliCtx:
+    debug: bool = False
+    sample: str | None = None
+
+
+# File handler which cleans log messages before writing them
+class CleanFileHandler(logging.FileHandler):
+    def emit(self, record):
+        s = record.getMessage()
+        # Remove newlines
+        s = s.replace("\n", " ")
+        # Remove ANSI color codes
+        s = re.sub(r'\x1b\[[0-9;]*m', '', s)
+        # Remove Emojis
+        s = re.sub(r'[^\x00-\x7F]+', '>', s)
+        rec = copy.copy(record)
+        rec.msg = s
+        rec.args = None
+        # Keep only the command name
+        rec.name = rec.name.removeprefix("cytoprocess.")
+        super().emit(rec)
+
+
+# Whether logging was configured for the `cytoprocess` namespace, in this process
+_CONFIGURED = False
+
+
+def _configure_logging(debug: bool = False):
+    """
+    Configure console logging for all loggers in the `cytoprocess` namespace, once per process.
+    
+    Subsequent calls only adjust the level of the console handler. Loggers outside
+    of the namespace (e.g. when cytoprocess is used as a library) are left untouched.
+    
+    Args:
+        debug: If True, console logs at DEBUG level; otherwise INFO level.
+    """
+    global _CONFIGURED
+    level = "DEBUG" if debug else "INFO"
+    
+    if _CONFIGURED:
+        for handler in logging.getLogger("cytoprocess").handlers:
+            if type(handler) is logging.StreamHandler:
+                handler.setLevel(level)
+        return
+    
+    logging.config.dictConfig({
+        "version": 1,
+        "disable_existing_loggers": False,
+        "formatters": {
+            "console": {"format": "%(message)s"},
+        },
+        "handlers": {
+            "console": {"class": "logging.StreamHandler", "level": level, "formatter": "console"},
+        },
+        "loggers": {
+            # Logger captures all; handlers filter
+            "cytoprocess": {"level": "DEBUG", "handlers": ["console"], "propagate": False},
+        },
+    })
+    _CONFIGURED = True
+
+
+# Cache configured loggers, per (command, project), and file handlers, per log file
+# so that repeated calls within the same process (e.g. in the `all` command) are no-ops
+# and do not re-open the log file
+_LOGGER_CACHE: dict[tuple[str, str], logging.Logger] = {}
+_FILE_HANDLERS: dict[str, logging.FileHandler] = {}
 
 
 def setup_logging(command: str = None, project: str = None, debug: bool = False) -> logging.Logger:
     """
     Set up logging for a command, with optional file and console handlers.
     
+    Handlers are attached to the `cytoprocess` logger, so that all loggers in this
+    namespace (e.g. module level loggers, or loggers in worker processes) use them.
+    
     Args:
         command: The command name (e.g., 'convert', 'cleanup')
         project: The project directory path. If provided, logs are also written to file.
@@ -26,47 +110,34 @@ def setup_logging(command: str = None, project: str = None, debug: bool = False)
         >>> logger = setup_logging('install')  # Console only
     """
 
-    logger = logging.getLogger(f"{command}" if command else "cytoprocess")
-    logger.setLevel(logging.DEBUG)  # Logger captures all; handlers filter
-    
-    # Prevent adding duplicate handlers if called multiple times
-    if logger.handlers:
-        return logger
-    
-    # Default console handler
-    console_handler = logging.StreamHandler()
-    console_handler.setLevel(logging.DEBUG if debug else logging.INFO)
-    console_handler.setFormatter(logging.Formatter('%(message)s'))
-    logger.addHandler(console_handler)
+    cache_key = (command, str(project))
+    if cache_key in _LOGGER_CACHE:
+        return _LOGGER_CACHE[cache_key]
+
+    _configure_logging(debug)
+    logger = logging.getLogger(f"cytoprocess.{command}" if command else "cytoprocess")
     
     # File handler (only if project is specified)
     if project is not None and Path(project).exists():
-        # Define a custom file handler that cleans log messages
-        class CleanupFormatter:
-            def emit(self, record):
-                s = record.getMessage()
-                # Remove newlines
-                s = s.replace("\n", " ")
-                # Remove ANSI color codes
-                s = re.sub(r'\x1b\[[0-9;]*m', '', s)
-                # Remove Emojis
-                s = re.sub(r'[^\x00-\x7F]+', '>', s)
-                rec = copy.copy(record)
-                rec.msg = s
-                super().emit(rec)
-        class CleanFileHandler(CleanupFormatter, logging.FileHandler):
-            pass
-        
         # Ensure logs directory exists
-        log_dir = Path(project) / "logs"
-        ensure_project_dir(project, "logs")
+        log_dir = ensure_project_dir(project, "logs")
         log_filename = f"{datetime.now().strftime('%Y-%m-%d')}_cytoprocess.log"
+        log_file = os.path.abspath(log_dir / log_filename)
         
-        file_handler = CleanFileHandler(log_dir / log_filename, mode='a')
-        file_handler.setLevel(logging.DEBUG)
-        file_handler.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)-7s\t%(name)-16s\t%(message)s'))
-        logger.addHandler(file_handler)
+        # Open the log file only once per process
+        file_handler = _FILE_HANDLERS.get(log_file)
+        if file_handler is None:
+            file_handler = CleanFileHandler(log_file, mode='a')
+            file_handler.setLevel(logging.DEBUG)
+            file_handler.setFormatter(logging.Formatter('%(asctime)s\t%(levelname)-7s\t%(name)-16s\t%(message)s'))
+            _FILE_HANDLERS[log_file] = file_handler
+        
+        # Guard against adding it twice (e.g. if the cache was bypassed)
+        namespace_logger = logging.getLogger("cytoprocess")
+        if not any(isinstance(h, logging.FileHandler) and h.baseFilename == log_file for h in namespace_logger.handlers):
+            namespace_logger.addHandler(file_handler)
     
+    _LOGGER_CACHE[cache_key] = logger
     return logger
 
 
@@ -105,6 +176,51 @@ def log_command_success(logger: logging.Logger, command: str):
     logger.info(f"{start}✅ {command} operation successful{reset}")
 
 
+# Paths of the standard subdirectories of a project
+@dataclass(frozen=True, slots=True)
+class ProjectLayout:
+    root: Path
+    raw: Path
+    converted: Path
+    meta: Path
+    work: Path
+    images: Path
+    ecotaxa: Path
+
+    def ensure(self, *subdirs: str):
+        """
+        Ensure some subdirectories of the project exist, creating them if needed.
+        
+        Args:
+            subdirs: Names of the subdirectories (e.g., "meta", "work")
+        """
+        for subdir in subdirs:
+            getattr(self, subdir).mkdir(parents=True, exist_ok=True)
+
+
+@functools.lru_cache(maxsize=8)
+def project_layout(project: str) -> ProjectLayout:
+    """
+    Get the paths of the standard subdirectories of a project.
+    
+    The paths are built once per project and reused by subsequent calls; their
+    existence is not cached, use ProjectLayout.ensure() or check it on the spot.
+    
+    Args:
+        project: The project directory path
+        
+    Returns:
+        ProjectLayout with the paths of the project directory and its subdirectories
+        
+    Examples:
+        >>> layout = project_layout('/path/to/project')
+        >>> layout.ensure('work')
+        >>> output_file = layout.work / 'sample_metadata_from_instrument.parquet'
+    """
+    root = Path(project)
+    return ProjectLayout(root, *(root / subdir for subdir in ("raw", "converted", "meta", "work", "images", "ecotaxa")))
+
+
 def ensure_project_dir(project: str, subdir: str) -> Path:
     """
     Ensure a subdirectory exists within a project directory.
@@ -127,6 +243,27 @@ def ensure_project_dir(project: str, subdir: str) -> Path:
     return target_dir
 
 
+def check_project_exists(project: str, logger: logging.Logger):
+    """
+    Check that a project directory exists, raising an error otherwise.
+    
+    Args:
+        project: The project directory path
+        logger: The logger instance to use for logging the error
+        
+    Examples:
+        >>> logger = logging.getLogger("cytoprocess.example")
+        >>> check_project_exists('/path/to/project', logger)
+    """
+    if not Path(project).exists():
+        raiseCytoError(f"Project directory '{project}' does not exist, run `cytoprocess create {project}` first.", logger)
+
+
+# Size of the chunks read from .json files by the streaming parser
+# (larger than ijson's default, to make fewer reads in large files)
+JSON_BUF_SIZE = 256 * 1024
+
+
 def get_json_section(json_file: Path, key: str, logger: logging.Logger):
     """
     Load a specific section from a JSON file using streaming.
@@ -147,7 +284,7 @@ def get_json_section(json_file: Path, key: str, logger: logging.Logger):
 
     with open(json_file, 'rb') as f:
         # Use ijson to stream only the specified part
-        parser = ijson.items(f, key)
+        parser = ijson.items(f, key, buf_size=JSON_BUF_SIZE)
         data = next(parser, None)
         
         if data is None:
@@ -156,6 +293,76 @@ def get_json_section(json_file: Path, key: str, logger: logging.Logger):
     return data
 
 
+# Use the C implementation of the YAML loader when libyaml is available
+try:
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_yaml(path: str, mtime_ns: int):
+    # mtime_ns is only part of the cache key, so that edited files are parsed again
+    with open(path, 'r') as f:
+        return yaml.load(f, Loader=_YamlLoader)
+
+
+def load_config(config_file: Path):
+    """
+    Load a YAML configuration file, parsing it only once while it is unchanged.
+    
+    Args:
+        config_file: Path to the YAML file (typically the project's config.yaml)
+        
+    Returns:
+        The parsed content (a fresh copy, that callers can modify), or None if the file is empty.
+        
+    Examples:
+        >>> config = load_config(Path('my_project/config.yaml'))
+        >>> config.get('object')
+    """
+    config = _parse_yaml(str(config_file), config_file.stat().st_mtime_ns)
+    return copy.deepcopy(config)
+
+
+def get_worker_context():
+    """
+    Get the multiprocessing context used to start worker processes.
+    
+    Uses 'forkserver' where available, because forking the main process is unsafe
+    when other threads run (e.g. several steps at once in the `all` command),
+    and 'spawn' otherwise.
+    
+    Examples:
+        >>> executor = ProcessPoolExecutor(max_workers=4, mp_context=get_worker_context())
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return multiprocessing.get_context(method)
+
+
+def scan_files(directory: Path, extension: str):
+    """
+    Iterate over the files with a given extension in a directory, using os.scandir.
+    
+    Unlike Path.glob, entries are streamed and their type comes from the directory
+    listing, so files do not need to be stat'ed. Hidden files are skipped, as with glob.
+    
+    Args:
+        directory: The directory to scan
+        extension: The file extension, including the dot (e.g., ".json")
+        
+    Yields:
+        os.DirEntry objects for the matching files.
+        
+    Examples:
+        >>> json_files = [Path(e.path) for e in scan_files(Path('converted'), '.json')]
+    """
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name.endswith(extension) and not entry.name.startswith(".") and entry.is_file():
+                yield entry
+
+
 def get_sample_files(project: str, logger: logging.Logger, kind: str = "json", ctx=None) -> list:
     """
     Get a list of files from a project's directory.
@@ -180,9 +387,9 @@ def get_sample_files(project: str, logger: logging.Logger, kind: str = "json", c
     
     # Determine directory and extension based on kind
     if kind == "json":
-        target_dir = Path(project) / "converted"
+        target_dir = project_layout(project).converted
     elif kind == "cyz":
-        target_dir = Path(project) / "raw"
+        target_dir = project_layout(project).raw
     else:
         raiseCytoError(f"kind must be 'json' or 'cyz', got '{kind}'", logger)
         
@@ -191,14 +398,14 @@ def get_sample_files(project: str, logger: logging.Logger, kind: str = "json", c
     
     # List all files of the specified kind
     logger.debug(f"Listing .{kind} files in '{target_dir}'")
-    files = list(target_dir.glob("*."+kind))
+    files = [Path(entry.path) for entry in scan_files(target_dir, "." + kind)]
     if len(files) == 0:
         logger.warning(f"No .{kind} files found in '{target_dir}'")
         return []
     logger.debug(f"Found {len(files)} .{kind} files in '{target_dir}'")
     
     # Filter by sample if specified
-    sample = getattr(ctx, "obj", {}).get("sample")
+    sample = ctx.obj.sample if ctx is not None else None
     if sample:
         files = [f for f in files if f.stem == sample]
         if len(files) == 0:
@@ -226,3 +433,101 @@ def raiseCytoError(message: str, logger: logging.Logger = None):
     if logger:
         logger.debug(message)
     raise click.ClickException(message)
+
+
+# Files read or written by each processing step, as glob patterns relative to the project directory
+# These define the state of the project that a step depends on, to skip it when nothing changed
+# NB: upload is not listed, its output is on EcoTaxa, so it always runs
+STEP_FILES = {
+    "convert": ["raw/*.cyz", "converted/*.json"],
+    "extract_meta": ["config.yaml", "converted/*.json", "work/sample_metadata_from_instrument.parquet"],
+    "extract_cyto": ["config.yaml", "converted/*.json", "work/*_cytometric_features.parquet"],
+    "summarise_pulses": ["converted/*.json", "work/*_pulses.parquet"],
+    "extract_images": ["converted/*.json", "images/*"],
+    "compute_features": ["images/*", "work/*_image_features.parquet"],
+    "prepare": ["meta/samples.csv", "work/*.parquet", "images/*", "ecotaxa/*.zip"],
+}
+
+# Record of the fingerprint of the project state after each step last ran successfully
+STATE_FILE = ".cytoprocess-state.json"
+# Serialise updates of the state file by steps running concurrently (in `all`)
+_STATE_LOCK = threading.Lock()
+
+
+def _step_fingerprint(step: str, project: str, params: dict) -> str:
+    """
+    Compute a fingerprint of a step's parameters and of the files it reads and writes.
+    
+    Args:
+        step: The step name (e.g., 'convert', 'extract_meta')
+        project: The project directory path
+        params: The parameters the step is run with
+        
+    Returns:
+        A hexadecimal digest, which changes when parameters or files (names, sizes, modification times) change.
+    """
+    project = Path(project)
+    h = hashlib.sha256()
+    h.update(json.dumps([step, sorted(params.items())], default=str).encode())
+    for pattern in STEP_FILES[step]:
+        for f in sorted(project.glob(pattern)):
+            stat = f.stat()
+            h.update(f"{f.relative_to(project)}\t{stat.st_size}\t{stat.st_mtime_ns}\n".encode())
+    return h.hexdigest()
+
+
+def _read_state(project: str) -> dict:
+    state_file = Path(project) / STATE_FILE
+    if not state_file.exists():
+        return {}
+    try:
+        return json.loads(state_file.read_text())
+    except ValueError:
+        return {}
+
+
+def needs_rerun(step: str, project: str, params: dict, force: bool = False) -> bool:
+    """
+    Check whether a processing step needs to be run again.
+    
+    Args:
+        step: The step name (e.g., 'convert', 'extract_meta')
+        project: The project directory path
+        params: The parameters the step is run with
+        force: If True, the step always needs to be run
+        
+    Returns:
+        True unless the step ran successfully before, with the same parameters,
+        and its input and output files did not change since.
+        
+    Examples:
+        >>> needs_rerun('convert', '/path/to/project', {'sample': None})
+    """
+    if force or step not in STEP_FILES:
+        return True
+    return _read_state(project).get(step) != _step_fingerprint(step, project, params)
+
+
+def mark_step_done(step: str, project: str, params: dict):
+    """
+    Record that a processing step ran successfully, in the project's state file.
+    
+    Args:
+        step: The step name (e.g., 'convert', 'extract_meta')
+        project: The project directory path
+        params: The parameters the step was run with
+        
+    Examples:
+        >>> mark_step_done('convert', '/path/to/project', {'sample': None})
+    """
+    if step not in STEP_FILES:
+        return
+    fingerprint = _step_fingerprint(step, project, params)
+    with _STATE_LOCK:
+        state = _read_state(project)
+        state[step] = fingerprint
+        # Write atomically, to never leave a partial state file behind
+        state_file = Path(project) / STATE_FILE
+        tmp_file = state_file.with_name(state_file.name + ".tmp")
+        tmp_file.write_text(json.dumps(state, indent=2))
+        os.replace(tmp_file, state_file)